@@ -0,0 +1,237 @@
+"""Benchmark suite of the pulse simulator
+
+Times System.compile, get_system_dressed_frame, Simulator.set_sequence, Simulator.run (both return_all modes)
+and tomography_data while scaling the number of qubits, the qubit dimension, the sequence length and the step width.
+The qubit scan stops at 4 qutrits and the sequence is shortened for the large systems (MAX_TRAJECTORY_BYTES),
+so that the full suite runs on a plain CPU machine. The results are written as json so that they can be compared across commits:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+sequence_parser is used if it is installed, otherwise synthetic waveforms with the same port interface are used.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import scipy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pulse_simulator.system import System
+from pulse_simulator.simulator import Simulator
+from pulse_simulator.util.frame import get_system_dressed_frame
+from pulse_simulator.util.visualize import tomography_data
+
+try:
+    from sequence_parser.sequence import Sequence
+    from sequence_parser.port import Port
+    from sequence_parser.instruction import FlatTop, RaisedCos
+    HAS_SEQUENCE_PARSER = True
+except ImportError:
+    HAS_SEQUENCE_PARSER = False
+
+FREQUENCIES = [8.0, 8.8131, 8.3717, 8.2291, 8.6473, 7.9182, 8.5049, 8.1163]
+EDGE = 30 # ns
+MAX_TRAJECTORY_BYTES = 2**28 # trajectory of run(return_all=True) kept in memory by one configuration
+
+class SyntheticPort:
+    """Stand-in for sequence_parser.Port holding a flat-top waveform with raised-cosine edges"""
+
+    def __init__(self, name, amplitude, duration):
+        self.name = name
+        self.amplitude = amplitude
+        self.duration = duration
+        self.if_freq = 0
+        self.DAC_STEP = 0.1
+
+    def compile(self):
+        n = int(round(self.duration/self.DAC_STEP)) + 1
+        self.time = np.arange(n)*self.DAC_STEP
+        envelope = np.ones(n)
+        rise = self.time < EDGE
+        fall = self.time > self.duration - EDGE
+        envelope[rise] = 0.5*(1 - np.cos(np.pi*self.time[rise]/EDGE))
+        envelope[fall] = 0.5*(1 - np.cos(np.pi*(self.duration - self.time[fall])/EDGE))
+        self.waveform = self.amplitude*envelope*np.exp(2j*np.pi*self.if_freq*self.time)
+
+class SyntheticSequence:
+    """Stand-in for sequence_parser.Sequence with one flat-top pulse on every port"""
+
+    def __init__(self, ports):
+        self.port_list = ports
+        self.trigger_position_list = []
+
+    def compile(self):
+        for port in self.port_list:
+            port.compile()
+
+    def draw(self, baseband=True):
+        pass
+
+def make_system(n_qubits, dim):
+    """build a chain of coupled transmons with one microwave drive per qubit"""
+    system = System()
+    for i in range(n_qubits):
+        system.add_qubit(idx=i, dim=dim, frequency=FREQUENCIES[i], anharmonicity=-0.4)
+    for i in range(n_qubits - 1):
+        system.add_coupling((i, i+1), coupling=0.01)
+    for i in range(n_qubits):
+        system.add_drive(i, qubit=i, amplitude=0.05, frequency=FREQUENCIES[(i+1) % n_qubits])
+    return system
+
+def make_sequence(n_qubits, length):
+    """build one flat-top pulse of the given length (ns) on every drive"""
+    if not HAS_SEQUENCE_PARSER:
+        return SyntheticSequence([SyntheticPort(i, 1.0, length) for i in range(n_qubits)])
+    sequence = Sequence()
+    for i in range(n_qubits):
+        sequence.add(FlatTop(RaisedCos(+1, EDGE), length - 2*EDGE), Port(i))
+    return sequence
+
+def measure(func, setup, repeat):
+    """time the function on fresh inputs and record the peak memory of one extra traced call
+    Args:
+        func (function) : function taking the output of setup
+        setup (function) : function preparing the inputs of each call (not timed)
+        repeat (int) : number of timed calls
+    Returns:
+        result (dict) : median and every time (s) and the peak traced memory (bytes)
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup()
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time":float(np.median(times)), "times":times, "peak_memory":peak}
+
+def run_case(n_qubits, dim, length, step, repeat):
+    """benchmark every stage on one configuration"""
+    conditions = [({0:"Sc"}, {0:"Qz"}), ({0:"Sp"}, {0:"Qx"}), ({"default":"Sp"}, {0:"Qy"})]
+    stages = {}
+
+    def compiled():
+        system = make_system(n_qubits, dim)
+        system.compile()
+        return system
+
+    def simulator(sequenced=True, run=False):
+        sim = Simulator()
+        sim.set_system(compiled())
+        if sequenced:
+            sim.set_sequence(make_sequence(n_qubits, length), step=step)
+        if run:
+            sim.run(return_all=True)
+        return sim
+
+    stages["compile"] = measure(lambda s: s.compile(), lambda: (make_system(n_qubits, dim),), repeat)
+    stages["dressed_frame"] = measure(get_system_dressed_frame, lambda: (compiled(),), repeat)
+    stages["set_sequence"] = measure(lambda sim, seq: sim.set_sequence(seq, step=step),
+                                     lambda: (simulator(sequenced=False), make_sequence(n_qubits, length)), repeat)
+    stages["run_all"] = measure(lambda sim: sim.run(return_all=True), lambda: (simulator(),), repeat)
+    stages["run_final"] = measure(lambda sim: sim.run(return_all=False), lambda: (simulator(),), repeat)
+
+    sim = simulator(run=True)
+    system = compiled()
+    stages["tomography"] = measure(tomography_data, lambda: (system, sim.unitary, conditions), repeat)
+
+    results = []
+    for stage, result in stages.items():
+        result.update({"stage":stage, "n_qubits":n_qubits, "dim":dim, "length":length, "step":step,
+                       "n_steps":int(round(length/step))})
+        results.append(result)
+    return results
+
+def fit_length(config):
+    """halve the sequence length until the trajectory fits into MAX_TRAJECTORY_BYTES (at least 100 ns)"""
+    step_bytes = 16*(config["dim"]**config["n_qubits"])**2
+    while config["length"] > 100 and (config["length"]/config["step"] + 1)*step_bytes > MAX_TRAJECTORY_BYTES:
+        config["length"] = max(100, config["length"]//2)
+    return config
+
+def cases(quick=False):
+    """configurations scaling one parameter at a time around (2 qubits, dim 3, 300 ns, 0.1 ns),
+    the large systems are run on shorter sequences so that the peak memory stays below about 1 GB"""
+    base = {"n_qubits":2, "dim":3, "length":300, "step":0.1}
+    scans = {
+        "n_qubits":[1, 2, 3] if quick else [1, 2, 3, 4],
+        "dim":[2, 3] if quick else [2, 3, 4, 5],
+        "length":[100, 300] if quick else [100, 300, 1000, 3000],
+        "step":[0.2, 0.1] if quick else [0.5, 0.2, 0.1, 0.05],
+    }
+    configs = []
+    for name, values in scans.items():
+        for value in values:
+            config = fit_length(dict(base, **{name:value}))
+            if config not in configs:
+                configs.append(config)
+    return configs
+
+def metadata():
+    """describe the environment and the commit of the benchmark run"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit":commit,
+        "date":time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":platform.python_version(),
+        "numpy":np.__version__,
+        "scipy":scipy.__version__,
+        "platform":platform.platform(),
+        "processor":platform.processor(),
+        "cpu_count":os.cpu_count(),
+        "sequence_parser":HAS_SEQUENCE_PARSER,
+    }
+
+def compare(results, reference):
+    """print the time and memory ratios against a previous result file"""
+    previous = {}
+    for r in reference["results"]:
+        previous[(r["stage"], r["n_qubits"], r["dim"], r["length"], r["step"])] = r
+    print(f"{'stage':<14}{'qubits':>7}{'dim':>5}{'length':>8}{'step':>6}{'time ratio':>12}{'memory ratio':>14}")
+    for r in results:
+        key = (r["stage"], r["n_qubits"], r["dim"], r["length"], r["step"])
+        if key not in previous:
+            continue
+        p = previous[key]
+        time_ratio = r["time"]/p["time"] if p["time"] else float("nan")
+        memory_ratio = r["peak_memory"]/p["peak_memory"] if p["peak_memory"] else float("nan")
+        print(f"{key[0]:<14}{key[1]:>7}{key[2]:>5}{key[3]:>8}{key[4]:>6}{time_ratio:>12.3f}{memory_ratio:>14.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the pulse simulator")
+    parser.add_argument("--output", default="benchmark_results.json", help="json file to write the results to")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed calls of each stage")
+    parser.add_argument("--quick", action="store_true", help="run a reduced set of configurations")
+    parser.add_argument("--compare", default=None, help="previous json file to compare the results with")
+    args = parser.parse_args()
+
+    results = []
+    for config in cases(args.quick):
+        print("running", config, flush=True)
+        results += run_case(repeat=args.repeat, **config)
+
+    with open(args.output, "w") as f:
+        json.dump({"metadata":metadata(), "results":results}, f, indent=1)
+    print("results written to", args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,92 @@
+import copy
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import scipy.linalg as lin
+import scipy.sparse as sp
+from scipy.sparse.linalg import expm_multiply
+from .util.propagator import expm_hermitian, frame_rotation, cumulative_product, parallel_cumulative_product
+from .util.propagator import GAUSS_NODES, magnus4_hamiltonian, cf4_hamiltonians
+from .util.segment import precompile, node_coefficients
+from .util.cache import PropagatorCache, SequenceCache
+from .util.adaptive import adaptive_evolution
+from .util.stats import Stats, timed
+from .util.gradient import adjoint_gradients, unitary_gradients
 
 class Simulator:
     """Class for computing the time-evolution with the arbitral pulse sequence"""
     
     def __init__(self):
-        pass
+        self.cache = None
+        self.lut = None
+        self.sequence_cache = None
+        self.sparse = False
+        self.stats = Stats()
+
+    def set_stats(self, enabled=True, hook=None):
+        """enable the timers and counters of the hot paths collected in self.stats
+        Args:
+            enabled (bool) : whether to collect the statistics (the overhead is negligible if disabled)
+            hook (function) : function called as hook(event, name, value) on every timer start and stop and every count,
+                such as for forwarding the ranges to an external profiler or logger
+        """
+        self.stats = Stats(enabled, hook)
+
+    def set_cache(self, maxsize=4096):
+        """enable the LRU cache of the step propagators shared by the following runs
+        Args:
+            maxsize (int) : maximum number of the cached propagators (None disables the cache)
+
+        The steps are keyed by the exact waveform coefficients including the if modulation, so a repeated pulse on a detuned drive
+        hits only if it starts at the same modulation phase (the echo copy shifted by an arbitrary delay is exponentiated again).
+        The hits come from idle and flat stretches, unmodulated drives and repeated runs of the same sequence.
+        """
+        if maxsize is None:
+            self.cache = None
+        else:
+            self.cache = PropagatorCache(maxsize)
         
-    def set_system(self, system, frame_frequency=None, n_truncate=None):
+    def set_lut(self, resolution=1e-4, maxsize=65536):
+        """enable the lookup table engine (engine="lut"), which quantizes the waveform coefficients of each step
+        and fills the table of the step propagators per quantized coefficient tuple lazily
+        Args:
+            resolution (float) : quantization step of the waveform coefficients (unit of the waveforms)
+            maxsize (int) : maximum number of the tabulated propagators (None disables the engine)
+
+        The table survives the following runs, so the recurring amplitudes across sequences are exponentiated only once.
+        """
+        if maxsize is None:
+            self.lut = None
+            return
+        if resolution <= 0:
+            raise ValueError(f'Resolution must be set > 0')
+        self.lut_resolution = resolution
+        self.lut = PropagatorCache(maxsize)
+
+    def set_sequence_cache(self, maxsize=16):
+        """enable the LRU cache of the compiled sequences keyed by (content of the sequence, if frequencies, step)
+        Args:
+            maxsize (int) : maximum number of the cached sequences (None disables the cache)
+        """
+        if maxsize is None:
+            self.sequence_cache = None
+        else:
+            self.sequence_cache = SequenceCache(maxsize)
+
+    def set_system(self, system, frame_frequency=None, n_truncate=None, sparse=False, cache=None):
         """register the quantum system to be simulated
         Args:
             system (System) : class for the target quantum system
             frame_frequency (float) : rotation frequency of the system simulating the time evolution
             n_truncate (int) : maximum excitation number to be simulated
+            sparse (bool) : whether to use the sparse backend (operators stay csr matrices and every run propagates with expm_multiply)
+            cache (bool or CompileCache) : cache of the compiled artefacts passed to System.compile
         """
-        system.compile(frame_frequency,n_truncate)
+        with self.stats.timer("system.compile"):
+            system.compile(frame_frequency,n_truncate,sparse,cache)
+        self.sparse = sparse
         self.dim = system.dim
         self.static_hamiltonian = system.static_hamiltonian_on_frame
         self.operators = system.dynamic_operators_on_frame
@@ -22,89 +94,892 @@ class Simulator:
         self.stopflags = system.dynamic_stopflags
         self.frame = system.frame_on_frame
         self.comp = system.comp
+        self.blocks = system.blocks
+        self.operator_keys = list(self.operators.keys())
+        self.split_operators = None
+        if system.truncation is None:
+            # the split integrator applies the drives in the bare basis, where each of them acts on one qubit
+            conv = sp.csr_matrix(system.conv, dtype=np.complex128)
+            static = self.static_hamiltonian.diagonal() if sp.issparse(self.static_hamiltonian) else np.diag(self.static_hamiltonian)
+            self.split_operators = {
+                "dims":list(system.dims), "conv":conv, "conv_dagger":conv.T.conj().tocsr(), "static":static.real,
+                "local":[(system.drives[key].qubit.idx, system.drives[key].operator_real(), system.drives[key].operator_imag()) for key in self.operator_keys],
+            }
+        if sparse:
+            self.operator_tensor = [op for key in self.operator_keys for op in self.operators[key]]
+            digest = hashlib.sha1()
+            for op in [self.static_hamiltonian] + self.operator_tensor:
+                digest.update(op.data.tobytes() + op.indices.tobytes() + op.indptr.tobytes())
+            self.system_key = digest.hexdigest()
+            return
+        self.operator_tensor = np.zeros([2*len(self.operator_keys), self.dim, self.dim], dtype=np.complex128)
+        for i, key in enumerate(self.operator_keys):
+            self.operator_tensor[2*i:2*i+2] = self.operators[key]
+        self.static_blocks = [(block,) + np.linalg.eigh(self.static_hamiltonian[np.ix_(block, block)]) for block in self.blocks]
+        self.system_key = hashlib.sha1(np.ascontiguousarray(self.static_hamiltonian).tobytes() + self.operator_tensor.tobytes()).hexdigest()
         
-    def set_sequence(self, sequence, step=0.1, visualize=False):
+    @timed("set_sequence")
+    def set_sequence(self, sequence, step=0.1, visualize=False, detunings=None):
         """register the pulse sequence to be simulated
         Args:
             sequence (Sequence) : class for the target pulse schedule (imported from sequence_parser)
             step (float) : time step width for simulation (ns)
+            detunings (dict) : {port name : detuning} overriding the detunings of the compiled drives
+
+        If the sequence cache is enabled, the unchanged sequence compiled with the same if frequencies and step is reused without sequence.compile().
         """
+        if_freqs = {}
         for port in sequence.port_list:
             if self.stopflags[port.name]:
-                port.if_freq = 0
+                if_freqs[port.name] = 0
+            elif detunings is not None and port.name in detunings:
+                if_freqs[port.name] = detunings[port.name]
             else:
-                port.if_freq = self.detunings[port.name]
-            port.DAC_STEP = step
-        sequence.compile()
+                if_freqs[port.name] = self.detunings[port.name]
+
+        compiled = None
+        if self.sequence_cache is not None:
+            key = self.sequence_cache.key(sequence, if_freqs, step)
+            compiled = self.sequence_cache.get(key)
+        if compiled is None:
+            for port in sequence.port_list:
+                port.if_freq = if_freqs[port.name]
+                port.DAC_STEP = step
+            with self.stats.timer("sequence.compile"):
+                sequence.compile()
+            compiled = {
+                "waveforms":{port.name:port.waveform for port in sequence.port_list},
+                "time":port.time,
+                "trigger_position_list":sequence.trigger_position_list,
+            }
+            if self.sequence_cache is not None:
+                # compiling may update the internal state of the sequence, so the key is taken again for the next call
+                key = self.sequence_cache.key(sequence, if_freqs, step)
+                self.sequence_cache.put(key, compiled)
         
         if visualize:
             sequence.draw(baseband=True)
         
-        self.waveforms = {}
-        for port in sequence.port_list:
-            self.waveforms[port.name] = (port.waveform.real, port.waveform.imag)
-        self.time = port.time
-        self.trigger_position_list = sequence.trigger_position_list
+        self.set_waveforms(**compiled)
+
+    def set_waveforms(self, waveforms, time=None, step=None, trigger_position_list=None):
+        """register the sampled waveforms directly without sequence_parser, the arrays are not copied
+        Args:
+            waveforms (dict) : {port name : complex waveform with the shape (T,), tuple (real part, imaginary part),
+                or path of a .npy file of the complex waveform opened as a memmap}, including the if modulation at the detuning
+            time (np.array) : sampling times (ns) with the shape (T,)
+            step (float) : time step width (ns) defining the sampling times from 0 if time is None
+            trigger_position_list (list) : trigger positions of the schedule used by the visualization
+        """
+        registered = {}
+        for name, waveform in waveforms.items():
+            if isinstance(waveform, str):
+                waveform = np.load(waveform, mmap_mode="r")
+            if isinstance(waveform, tuple):
+                real, imag = np.asarray(waveform[0]), np.asarray(waveform[1])
+            else:
+                waveform = np.asarray(waveform)
+                real, imag = waveform.real, waveform.imag
+            registered[name] = (real, imag)
+
+        shapes = {part.shape for pair in registered.values() for part in pair}
+        if len(shapes) != 1 or len(next(iter(shapes))) != 1:
+            raise ValueError(f'Waveforms must be one-dimensional with the same length.')
+        size = next(iter(shapes))[0]
+        if time is None:
+            if step is None:
+                raise ValueError(f'Either time or step must be given.')
+            time = np.arange(size)*step
+        time = np.asarray(time)
+        if time.shape != (size,):
+            raise ValueError(f'Sampling times with the shape {time.shape} do not match the waveforms of the length {size}.')
+
+        self.waveforms = registered
+        self.time = time
+        self.trigger_position_list = [] if trigger_position_list is None else trigger_position_list
+        self.stats.count("samples", self.time.size)
+
+    def _waveform_matrix(self):
+        """stack the registered waveforms in the order of the operator tensor
+        Returns:
+            waveforms (np.array) : waveform matrix with the shape (n_ops, T)
+        """
+        waveforms = np.zeros([2*len(self.operator_keys), self.time.size])
+        for i, key in enumerate(self.operator_keys):
+            waveforms[2*i:2*i+2] = self.waveforms[key]
+        return waveforms
+
+    def _hamiltonians(self, coefficients):
+        """assemble the hamiltonians from the waveform coefficients with one tensor contraction
+        Args:
+            coefficients (np.array) : waveform coefficients with the shape (T, n_ops), or (n_ops,) for a single hamiltonian
+        Returns:
+            hamiltonians (np.array) : stacked hamiltonians with the shape (T, dim, dim), or a csr matrix on the sparse backend
+        """
+        if self.sparse:
+            hamiltonian = self.static_hamiltonian.copy()
+            for c, op in zip(coefficients, self.operator_tensor):
+                if c != 0:
+                    hamiltonian = hamiltonian + c*op
+            return hamiltonian
+        hamiltonians = np.tensordot(coefficients, self.operator_tensor, axes=1)
+        hamiltonians += self.static_hamiltonian
+        return hamiltonians
+
+    def _step_propagators(self, s_list, c_list, engine, pool=None, chunks=1, integrator="midpoint"):
+        """compute the propagator of each step, reusing the cached ones if the cache is enabled
+        Args:
+            s_list (np.array) : width of each step
+            c_list (np.array) : waveform coefficients of each step with the shape (n_steps, n_ops),
+                or (n_steps, 2, n_ops) at the gauss nodes for the fourth-order integrators
+            engine (str) : "expm", "eigh" or "lut"
+            pool (Executor) : pool of workers to exponentiate the steps in chunks
+            chunks (int) : number of chunks distributed on the pool
+            integrator (str) : "midpoint", "magnus4" or "cf4"
+        Returns:
+            steps (np.array) : stacked step propagators with the shape (n_steps, dim, dim)
+        """
+
+        def exponentiate(idx):
+            if pool is not None:
+                idx = np.arange(s_list.size)[idx]
+                ranges = [r for r in np.array_split(idx, chunks) if r.size > 0]
+                if len(ranges) > 1:
+                    return np.concatenate(list(pool.map(exponentiate_chunk, ranges)))
+            return exponentiate_chunk(idx)
+
+        def exponentiate_chunk(idx):
+            c_chunk, s_chunk = c_list[idx], s_list[idx]
+            # idle steps only see the static hamiltonian, which is exponentiated block by block
+            idle = ~c_chunk.any(axis=tuple(range(1, c_chunk.ndim)))
+            steps = np.empty([s_chunk.size, self.dim, self.dim], dtype=np.complex128)
+            if idle.any():
+                steps[idle] = self._static_propagators(s_chunk[idle])
+                self.stats.count("idle_steps", int(idle.sum()))
+            if not idle.all():
+                steps[~idle] = exponentiate_driven(c_chunk[~idle], s_chunk[~idle])
+            return steps
+
+        def exponentiate_driven(c_list, s_list):
+            self.stats.count("expm", s_list.size*(2 if integrator == "cf4" else 1))
+            h_list = self._hamiltonians(c_list)
+            if integrator == "magnus4":
+                h_list = magnus4_hamiltonian(h_list[:,0], h_list[:,1], s_list)
+            if integrator == "cf4":
+                first, second = cf4_hamiltonians(h_list[:,0], h_list[:,1])
+                return exponentiate_hamiltonians(second, s_list)@exponentiate_hamiltonians(first, s_list)
+            return exponentiate_hamiltonians(h_list, s_list)
+
+        def exponentiate_hamiltonians(h_list, s_list):
+            if engine == "expm":
+                steps = np.empty(h_list.shape, dtype=np.complex128)
+                for i, (h, s) in enumerate(zip(h_list, s_list)):
+                    steps[i] = lin.expm(-1j*h*s)
+                return steps
+            return expm_hermitian(h_list, s_list)
+
+        if s_list.size == 0:
+            return np.empty([0, self.dim, self.dim], dtype=np.complex128)
+        cache, c_keys = self.cache, c_list
+        if engine == "lut":
+            # ||U - U_lut|| <= sum_k s_k ||H_k - H_k^lut|| <= sum_k s_k sum_j |c_kj - q(c_kj)| ||O_j||
+            # the integer indices key the table, so -0.0 and 0.0 do not split the entries
+            index = np.round(c_list/self.lut_resolution).astype(np.int64)
+            quantized = index*self.lut_resolution
+            self.lut_error_bound += float(s_list@(abs(c_list - quantized)@self._operator_norms()))
+            c_list, c_keys, cache, engine = quantized, index, self.lut, "eigh"
+
+        with self.stats.timer("exponentiate"):
+            if cache is None:
+                return exponentiate(slice(None))
+            # step widths are rounded so that sampling jitter of the time axis does not split the keys
+            keys = [(self.system_key, integrator, round(s, 12), c.tobytes()) for s, c in zip(s_list, c_keys)]
+            hits, misses = cache.hits, cache.misses
+            steps = cache.lookup(keys, exponentiate)
+            self.stats.count("cache_hits", cache.hits - hits)
+            self.stats.count("cache_misses", cache.misses - misses)
+            return steps
+
+    def _operator_norms(self):
+        """return the spectral norms of the operators multiplied by the waveform coefficients
+        Returns:
+            norms (np.array) : norms with the shape (n_ops,)
+        """
+        if getattr(self, "operator_norms_key", None) != self.system_key:
+            self.operator_norms = np.array([np.linalg.norm(op, 2) for op in self.operator_tensor])
+            self.operator_norms_key = self.system_key
+        return self.operator_norms
+
+    def _static_propagators(self, s_list):
+        """compute the propagators exp(-1j*H0*s) of the static hamiltonian block by block over the excitation manifolds
+        Args:
+            s_list (np.array) : width of each step
+        Returns:
+            steps (np.array) : stacked propagators with the shape (n_steps, dim, dim)
+        """
+        steps = np.zeros([s_list.size, self.dim, self.dim], dtype=np.complex128)
+        for block, val, vec in self.static_blocks:
+            phase = np.exp(-1j*np.outer(s_list, val))
+            steps[:, block[:,None], block[None,:]] = (vec*phase[:,None,:])@vec.T.conj()
+        return steps
+
+    def _split_propagation(self, s_list, c_list, order, return_all):
+        """propagate the unitary by the split-operator integrator
+        Args:
+            s_list (np.array) : width of each step
+            c_list (np.array) : waveform coefficients of each step with the shape (n_steps, n_ops)
+            order (int) : 1 (Lie-Trotter), 2 (Strang) or 4 (fourth-order composition of the Strang steps)
+            return_all (bool) : whether to return the unitary at every step
+        Returns:
+            u (np.array) : unitaries on the dressed frame with the shape (n_steps+1, dim, dim) if return_all, otherwise (dim, dim)
+        """
+        if order == 1:
+            stages = [("static", 1.0), ("drive", 1.0)]
+        elif order == 2:
+            stages = [("static", 0.5), ("drive", 1.0), ("static", 0.5)]
+        elif order == 4:
+            w1 = 1/(2 - 2**(1/3))
+            w0 = 1 - 2*w1
+            stages = [("static", 0.5*w1), ("drive", w1), ("static", 0.5*(w0 + w1)), ("drive", w0),
+                      ("static", 0.5*(w0 + w1)), ("drive", w1), ("static", 0.5*w1)]
+        else:
+            raise ValueError(f'Split order {order} is not supported.')
+
+        split = self.split_operators
+        dims = split["dims"]
+        with self.stats.timer("exponentiate"):
+            # the drives on the same qubit are summed into one local hamiltonian per step
+            local = {}
+            for i, (q, operator_real, operator_imag) in enumerate(split["local"]):
+                h = np.multiply.outer(c_list[:,2*i], operator_real) + np.multiply.outer(c_list[:,2*i+1], operator_imag)
+                local[q] = local.get(q, 0) + h
+            exponentials = {}
+            for kind, fraction in stages:
+                if kind == "drive" and fraction not in exponentials:
+                    exponentials[fraction] = {q:expm_hermitian(h, fraction*s_list) for q, h in local.items()}
+        self.stats.count("local_expm", sum(len(e)*s_list.size for e in exponentials.values()))
+        idle = ~c_list.any(axis=1)
+
+        def drive(u, fraction, k):
+            # conv maps the dressed frame to the bare basis, where each exponential acts on its tensor axis
+            x = (split["conv"]@u).reshape(dims + [self.dim])
+            for q, e in exponentials[fraction].items():
+                x = np.moveaxis(np.tensordot(e[k], x, axes=([1],[q])), 0, q)
+            return split["conv_dagger"]@x.reshape(self.dim, self.dim)
+
+        u = np.identity(self.dim, dtype=np.complex128)
+        trajectory = [u] if return_all else None
+        with self.stats.timer("accumulate"):
+            for k, s in enumerate(s_list):
+                if idle[k]:
+                    u = np.exp(-1j*split["static"]*s)[:,None]*u
+                else:
+                    for kind, fraction in stages:
+                        if kind == "static":
+                            u = np.exp(-1j*split["static"]*fraction*s)[:,None]*u
+                        else:
+                            u = drive(u, fraction, k)
+                if return_all:
+                    trajectory.append(u)
+        if return_all:
+            return np.array(trajectory)
+        return u
+
+    def _propagate_columns(self, psi, s_list, c_list, return_all):
+        """propagate the column vectors by the action of the step exponentials
+        Args:
+            psi (np.array) : initial column vectors with the shape (dim, k)
+            s_list (np.array) : width of each step
+            c_list (np.array) : waveform coefficients of each step with the shape (n_steps, n_ops)
+            return_all (bool) : whether to return the vectors at every step
+        Returns:
+            trajectory (np.array) : propagated vectors with the shape (n_steps+1, dim, k) if return_all, otherwise (dim, k)
+        """
+        if sp.issparse(self.frame) and (self.frame - sp.diags(self.frame.diagonal())).count_nonzero() == 0:
+            frame_val, frame_vec = self.frame.diagonal().real, None
+        else:
+            frame_val, frame_vec = np.linalg.eigh(self.frame.toarray() if sp.issparse(self.frame) else self.frame)
+        def on_frame(psi, t):
+            if frame_vec is None:
+                return np.exp(+1j*frame_val*t)[:,None]*psi
+            return frame_vec@(np.exp(+1j*frame_val*t)[:,None]*(frame_vec.T.conj()@psi))
+
+        trajectory = [psi]
+        with self.stats.timer("expm_multiply"):
+            for s, c in zip(s_list, c_list):
+                psi = expm_multiply(-1j*s*self._hamiltonians(c), psi)
+                if return_all:
+                    trajectory.append(psi)
+        self.stats.count("expm_multiply", s_list.size)
+        t_list = np.concatenate([[0], np.cumsum(s_list)])
+        with self.stats.timer("frame_rotation"):
+            if return_all:
+                trajectory = np.array([on_frame(psi, t) for psi, t in zip(trajectory, t_list)])
+                self.stats.count("trajectory_bytes", trajectory.nbytes)
+                return trajectory
+            return on_frame(psi, t_list[-1])
+
+    def _propagate_states(self, s_list, c_list, initial_states, return_all):
+        """propagate only the initial states by the action of the step exponentials
+        Args:
+            s_list (np.array) : width of each step
+            c_list (np.array) : waveform coefficients of each step with the shape (n_steps, n_ops)
+            initial_states (list) : state vectors with the shape (dim,) or density matrices with the shape (dim, dim)
+            return_all (bool) : whether to return the states at every step
+        Returns:
+            states (list) : propagated states in the order of initial_states
+        """
+        # density matrices are propagated through their weighted eigenvectors, rho = sum_k w_k w_k^dag
+        columns = []
+        slices = []
+        for ini in initial_states:
+            ini = np.asarray(ini, dtype=np.complex128)
+            if ini.ndim == 1:
+                vectors = ini[:,None]
+            else:
+                val, vec = np.linalg.eigh(ini)
+                keep = val > 1e-12*max(abs(val).max(), 1e-300)
+                vectors = vec[:,keep]*np.sqrt(val[keep])
+            slices.append(slice(sum(c.shape[1] for c in columns), sum(c.shape[1] for c in columns) + vectors.shape[1]))
+            columns.append(vectors)
+        trajectory = self._propagate_columns(np.concatenate(columns, axis=1), s_list, c_list, return_all)
+
+        states = []
+        for ini, sl in zip(initial_states, slices):
+            vectors = trajectory[...,sl]
+            if np.ndim(ini) == 1:
+                states.append(vectors[...,0])
+            else:
+                states.append(vectors@np.swapaxes(vectors, -1, -2).conj())
+        return states
+
+    def stream(self, engine="eigh", decimation=1, chunk=1024, integrator="midpoint"):
+        """yield the unitary at every sampling point lazily, holding only one chunk of steps in memory
+        Args:
+            engine (str) : "expm", "eigh" or "lut"
+            decimation (int) : yield only every decimation-th sampling point (starting from time[0])
+            chunk (int) : number of steps exponentiated at once
+            integrator (str) : "midpoint", "magnus4" or "cf4" (the fourth-order ones are not supported on the sparse backend)
+        Yields:
+            time (float) : simulation time (ns)
+            unitary (np.array) : unitary at the time
+        """
+        if decimation < 1:
+            raise ValueError(f'Decimation must be set >= 1')
+        self._check_engine(engine, integrator)
+        self._check_integrator(integrator, streamed=True)
+        self.lut_error_bound = 0.0
+
+        i_list, s_list, c_list = self._precompile(True, integrator)
+        t_list = np.concatenate([[0], np.cumsum(s_list)])
+        u = np.identity(self.dim, dtype=np.complex128)
+        yield self.time[0], u
+        for start in range(0, s_list.size, chunk):
+            stop = min(start + chunk, s_list.size)
+            index = [i for i in range(start+1, stop+1) if i % decimation == 0]
+            frames = frame_rotation(self.frame, t_list[index]) if index else []
+            frames = iter(frames)
+            if not self.sparse:
+                steps = self._step_propagators(s_list[start:stop], c_list[start:stop], engine, integrator=integrator)
+            for i in range(start, stop):
+                if self.sparse:
+                    u = expm_multiply(-1j*s_list[i]*self._hamiltonians(c_list[i]), u)
+                else:
+                    u = steps[i-start]@u
+                if (i+1) % decimation == 0:
+                    yield self.time[i_list[i+1]], next(frames)@u
 
-    def run(self, return_all=True):
+    def _check_engine(self, engine, integrator="midpoint"):
+        """validate the engine
+        Args:
+            engine (str) : "expm", "eigh" or "lut"
+            integrator (str) : "midpoint", "magnus4" or "cf4"
+        """
+        if engine not in ["expm", "eigh", "lut"]:
+            raise ValueError(f'Engine {engine} is not supported.')
+        if engine == "lut" and self.lut is None:
+            raise ValueError(f'Engine lut requires the lookup table enabled by set_lut.')
+        if engine == "lut" and integrator != "midpoint":
+            raise ValueError(f'Engine lut supports only the midpoint integrator.')
+
+    def _check_integrator(self, integrator, states=False, streamed=False):
+        """validate the integrator for the current backend
+        Args:
+            integrator (str) : "midpoint", "magnus4", "cf4" or "split"
+            states (bool) : whether the columns are propagated with expm_multiply
+            streamed (bool) : whether the unitaries are streamed step by step
+        """
+        if integrator not in ["midpoint", "magnus4", "cf4", "split"]:
+            raise ValueError(f'Integrator {integrator} is not supported.')
+        if integrator == "split":
+            if states or streamed:
+                raise ValueError(f'Integrator split supports only the unitary propagation of run.')
+            if self.split_operators is None:
+                raise ValueError(f'Integrator split requires the untruncated tensor product basis.')
+            return
+        if integrator != "midpoint" and (self.sparse or states):
+            raise ValueError(f'Integrator {integrator} requires the dense unitary propagation.')
+
+    def _precompile(self, return_all, integrator="midpoint"):
+        """split the registered waveforms into the steps for the integrator
+        Args:
+            return_all (bool) : whether to keep every sampling point
+            integrator (str) : "midpoint", "magnus4" or "cf4"
+        Returns:
+            i_list (np.array) : sample index at the end of each step (starting from 0)
+            s_list (np.array) : width of each step
+            c_list (np.array) : waveform coefficients of each step (at the gauss nodes for the fourth-order integrators)
+        """
+        time = 2*np.pi*self.time
+        waveforms = self._waveform_matrix()
+        with self.stats.timer("precompile"):
+            i_list, s_list, c_list = precompile(time, waveforms, return_all)
+            if integrator != "midpoint":
+                c_list = node_coefficients(time, waveforms, i_list, c_list, GAUSS_NODES)
+        self.stats.count("segments", s_list.size)
+        return i_list, s_list, c_list
+
+    @timed("run")
+    def run(self, return_all=True, engine="expm", workers=None, initial_states=None, callbacks=None, decimation=1, out=None, dtype=np.complex128, integrator="midpoint", adaptive=False, tol=1e-8, times=None, split_order=2):
         """run the simulation
         Args:
             return_all (float) : whether to return the simulation results during pulse execution
+            engine (str) : "expm" exponentiates each step with scipy, "eigh" exponentiates all steps at once with batched eigh,
+                "lut" looks up the steps in the table of set_lut after quantizing the waveform coefficients,
+                the bound on the spectral norm of the resulting error of the final unitary is stored in self.lut_error_bound
+            workers (int) : number of threads computing the step propagators and their products in chunks (None runs sequentially)
+            initial_states (list) : state vectors or density matrices to be propagated instead of the full unitary,
+                the results are stored in self.states (engine and workers are not used)
+            callbacks (dict) : {name : function mapping a unitary to a value} evaluated on the streamed trajectory instead of storing it,
+                the results are stored in self.observables and their times in self.observable_time
+                (requires return_all, and initial_states and workers are rejected as for out)
+            decimation (int) : evaluate the callbacks (or write to out) only on every decimation-th sampling point
+            out (str) : path of the .npy file to which the trajectory with the shape (T, dim, dim) is streamed,
+                self.unitary is then a read-only memmap of the file (requires return_all)
+            dtype (np.dtype) : dtype of the file, np.complex64 halves its size
+            integrator (str) : "midpoint" (second order), "magnus4" (fourth-order magnus) or "cf4" (fourth-order commutator-free),
+                the fourth-order ones evaluate the cubic spline of the waveforms at the two gauss nodes of each step
+            adaptive (bool) : whether to choose the step widths by step doubling of the magnus4 integrator against tol,
+                constant runs of the waveforms are exponentiated at once (the cache is not used, and the integrators other than magnus4,
+                the lut engine, workers, callbacks and out are rejected)
+            tol (float) : tolerance on the local error of each adaptive step
+            times (np.array) : times (ns) at which the adaptive unitaries are returned if return_all (default is self.time),
+                they are stored in self.unitary_time
+            split_order (int) : order of the "split" integrator, which applies the static part as the diagonal phase of the dressed frame
+                and the drives as the local exponentials on the tensor axes of their qubits (engine and the cache are not used, workers are rejected),
+                1 (Lie-Trotter), 2 (Strang) or 4 (fourth-order composition of the Strang steps)
+
+        On the sparse backend the unitary is propagated column-wise with expm_multiply, and engine, workers and the cache are not used.
         """
+        self._check_engine(engine, integrator)
+        self._check_integrator(integrator, initial_states is not None, callbacks is not None or out is not None)
+        self.lut_error_bound = 0.0
+        if adaptive:
+            # the adaptive steps are always taken by the magnus4 integrator on the calling thread
+            if integrator not in ["midpoint", "magnus4"]:
+                raise ValueError(f'Adaptive time stepping uses the magnus4 integrator and cannot run {integrator}.')
+            if engine == "lut" or (workers is not None and workers > 1):
+                raise ValueError(f'Adaptive time stepping does not use the lut engine or workers.')
+            if callbacks is not None or out is not None:
+                raise ValueError(f'Adaptive time stepping cannot stream to callbacks or out.')
+        elif times is not None:
+            raise ValueError(f'Output times are only used by adaptive time stepping.')
+        if integrator != "split" and split_order != 2:
+            raise ValueError(f'Split order is only used by the split integrator.')
+        if callbacks is not None or out is not None:
+            # the streamed unitaries are propagated step by step on the calling thread
+            if initial_states is not None:
+                raise ValueError(f'Streaming to callbacks or out propagates the full unitary and cannot take initial_states.')
+            if workers is not None and workers > 1:
+                raise ValueError(f'Streaming to callbacks or out exponentiates the steps sequentially without workers.')
+            if not return_all:
+                raise ValueError(f'Streaming to callbacks or out requires return_all=True.')
+            if callbacks is not None and out is not None:
+                raise ValueError(f'Callbacks and out cannot be combined.')
 
-        def ith_hamiltonian(i):
-            tmp = 0j + self.static_hamiltonian
-            for key in self.operators.keys():
-                waveforms = self.waveforms[key]
-                operators = self.operators[key]
-                for waveform, operator in zip(waveforms, operators):
-                    tmp += waveform[i]*operator
-            return tmp
-        
-        def compare_waveform(i,j):
-            for key in self.operators.keys():
-                waveforms = self.waveforms[key]
-                for waveform in waveforms:
-                    if waveform[i] != waveform[j]:
-                        return False
-            return True
-        
-        def precompile(time, ith_hamiltonian):
-            h0 = ith_hamiltonian(0)
-            i_list = [0]
-            s_list = []
-            h_list = []
-            for i in range(1,time.size):
-                flag_wave = compare_waveform(i, i_list[-1])
-                if return_all or (not flag_wave) or (i==time.size-1):
-                    h1 = ith_hamiltonian(i)
-                    if i - i_list[-1] >= 2:
-                        i_list.append(i-1)
-                        s_list.append(time[i-1] - time[i_list[-2]])
-                        h_list.append(h0)
-                    i_list.append(i)
-                    s_list.append(time[i] - time[i-1])
-                    h_list.append(0.5*(h0+h1))
-                    h0 = h1
-            return i_list, s_list, h_list
-
-        def time_evolution(s_list, h_list, frame):
-            u = np.identity(self.dim)
-            f = np.identity(self.dim)
-
-            unitary = [u]
-            for h,s in zip(h_list, s_list):
-                u = lin.expm(-1j*h*s)@u
+        if callbacks is not None:
+            times = []
+            values = {name:[] for name in callbacks.keys()}
+            for time, unitary in self.stream(engine, decimation, integrator=integrator):
+                times.append(time)
+                for name, callback in callbacks.items():
+                    values[name].append(callback(unitary))
+            self.observable_time = np.array(times)
+            self.observables = {name:np.array(value) for name, value in values.items()}
+            return
+
+        if out is not None:
+            size = (self.time.size - 1)//decimation + 1
+            unitary = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=(int(size), int(self.dim), int(self.dim)))
+            for i, (time, u) in enumerate(self.stream(engine, decimation, integrator=integrator)):
+                unitary[i] = u
+            unitary.flush()
+            self.stats.count("trajectory_bytes", unitary.nbytes)
+            del unitary
+            self.unitary = np.load(out, mmap_mode="r")
+            return
+
+        if adaptive:
+            if self.sparse or initial_states is not None:
+                raise ValueError(f'Adaptive time stepping requires the dense unitary propagation.')
+            if return_all:
+                self.unitary_time = self.time if times is None else np.asarray(times)
+            else:
+                self.unitary_time = self.time[-1:]
+            with self.stats.timer("adaptive"):
+                u, self.adaptive_steps = adaptive_evolution(2*np.pi*self.time, self._waveform_matrix(), self._hamiltonians, tol, 2*np.pi*self.unitary_time)
+            self.stats.count("adaptive_steps", self.adaptive_steps)
+            with self.stats.timer("frame_rotation"):
+                f = frame_rotation(self.frame, 2*np.pi*(self.unitary_time - self.time[0]))
+                self.unitary = f@u if return_all else f[0]@u[0]
+            self.stats.count("trajectory_bytes", self.unitary.nbytes)
+            return
+
+        if integrator == "split":
+            if workers is not None and workers > 1:
+                raise ValueError(f'Integrator split applies the local exponentials sequentially without workers.')
+            # every sampling interval is one step, the splitting error grows with the step width
+            t_list, s_list, c_list = self._precompile(True)
+            u = self._split_propagation(s_list, c_list, split_order, return_all)
+            with self.stats.timer("frame_rotation"):
+                if return_all:
+                    f = frame_rotation(self.frame, np.concatenate([[0], np.cumsum(s_list)]))
+                else:
+                    f = frame_rotation(self.frame, [s_list.sum()])[0]
+                self.unitary = f@u
+            self.stats.count("trajectory_bytes", self.unitary.nbytes)
+            return
+
+        t_list, s_list, c_list = self._precompile(return_all, integrator)
+        if initial_states is not None:
+            self.states = self._propagate_states(s_list, c_list, initial_states, return_all)
+            return
+        if self.sparse:
+            self.unitary = self._propagate_columns(np.identity(self.dim, dtype=np.complex128), s_list, c_list, return_all)
+            return
+
+        if workers is not None and workers > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                steps = self._step_propagators(s_list, c_list, engine, pool, workers, integrator)
+                with self.stats.timer("accumulate"):
+                    u = parallel_cumulative_product(steps, pool, workers, return_all)
+            with self.stats.timer("frame_rotation"):
                 if return_all:
-                    f = lin.expm(+1j*frame*s)@f
-                    unitary.append(f@u)
+                    f = frame_rotation(self.frame, np.concatenate([[0], np.cumsum(s_list)]))
+                else:
+                    f = frame_rotation(self.frame, [s_list.sum()])[0]
+                self.unitary = f@u
+            self.stats.count("trajectory_bytes", self.unitary.nbytes)
+            return
+
+        # the steps are exponentiated and accumulated in chunks, so only the trajectory itself scales with the number of steps
+        chunk = max(1, 2**18//(self.dim*self.dim))
+        t_list = np.concatenate([[0], np.cumsum(s_list)])
+        u = np.identity(self.dim, dtype=np.complex128)
+        if return_all:
+            unitary = np.empty([s_list.size+1, self.dim, self.dim], dtype=np.complex128)
+            unitary[0] = u
+        for start in range(0, s_list.size, chunk):
+            stop = min(start + chunk, s_list.size)
+            steps = self._step_propagators(s_list[start:stop], c_list[start:stop], engine, integrator=integrator)
+            with self.stats.timer("accumulate"):
+                for i, step in enumerate(steps):
+                    u = step@u
+                    if return_all:
+                        unitary[start+i+1] = u
+        with self.stats.timer("frame_rotation"):
+            if return_all:
+                for start in range(0, unitary.shape[0], chunk):
+                    stop = min(start + chunk, unitary.shape[0])
+                    unitary[start:stop] = frame_rotation(self.frame, t_list[start:stop])@unitary[start:stop]
+                self.unitary = unitary
+            else:
+                self.unitary = frame_rotation(self.frame, t_list[-1:])[0]@u
+        self.stats.count("trajectory_bytes", self.unitary.nbytes)
+
+    @timed("gradient")
+    def gradient(self, target=None):
+        """compute the exact gradients with respect to every waveform sample by the adjoint propagation,
+        reusing the eigendecompositions of the forward steps (midpoint integrator on every sampling interval)
+        Args:
+            target (np.array) : target unitary on the computational subspace (None differentiates the final unitary itself)
+        Returns:
+            fidelity (float) : average gate fidelity of the final unitary against the target (only if target is given)
+            gradients (dict) : {port name : (gradient for the real part, gradient for the imaginary part)} of the registered waveforms
+                including the if modulation, each with the shape (T,) for the fidelity or (T, dim, dim) for the final unitary
+
+        The final unitary is stored in self.unitary.
+        """
+        if self.sparse:
+            raise ValueError(f'Gradients require the dense unitary propagation.')
+        i_list, s_list, c_list = self._precompile(True)
+        with self.stats.timer("exponentiate"):
+            steps, val, vec = expm_hermitian(self._hamiltonians(c_list), s_list, return_eigen=True)
+        self.stats.count("expm", s_list.size)
+        with self.stats.timer("accumulate"):
+            prefix = cumulative_product(steps)
+        f = frame_rotation(self.frame, [s_list.sum()])[0]
+        self.unitary = f@prefix[-1]
+
+        with self.stats.timer("adjoint"):
+            if target is None:
+                step_gradients = unitary_gradients(steps, prefix, val, vec, s_list, self.operator_tensor, f)
+            else:
+                # dF = 2 Re tr(M^dag dM) + 2 Re(conj(tr(V^dag M)) tr(V^dag dM)) over d(d+1) with M the computational block
+                comp = np.asarray(self.comp)
+                target = np.asarray(target)
+                d = target.shape[0]
+                m = self.unitary[np.ix_(comp, comp)]
+                overlap = np.trace(target.conj().T@m)
+                fidelity = (np.sum(abs(m)**2) + abs(overlap)**2)/(d*(d + 1))
+                left = np.zeros([self.dim, self.dim], dtype=np.complex128)
+                left[np.ix_(comp, comp)] = 2*(m.conj().T + overlap.conj()*target.conj().T)/(d*(d + 1))
+                step_gradients = adjoint_gradients(steps, prefix, val, vec, s_list, self.operator_tensor, left@f)
+
+        # each step takes the mean of its two end samples
+        sample_gradients = np.zeros((self.time.size,) + step_gradients.shape[1:], dtype=step_gradients.dtype)
+        sample_gradients[:-1] += 0.5*step_gradients
+        sample_gradients[1:] += 0.5*step_gradients
+        gradients = {}
+        for i, key in enumerate(self.operator_keys):
+            gradients[key] = (sample_gradients[:,2*i], sample_gradients[:,2*i+1])
+        if target is None:
+            return gradients
+        return fidelity, gradients
+
+    def sweep(self, sequence_factory, grid, step=0.1, engine="eigh", processes=None):
+        """run the simulation over the parameter grid on a process pool
+        Args:
+            sequence_factory (function) : module-level function mapping the parameters of a grid point to a Sequence,
+                or to a tuple (Sequence, {port name : detuning}) for sweeping the drive frequencies
+            grid (dict) : {parameter name : list of the values} to be swept
+            step (float) : time step width for simulation (ns)
+            engine (str) : "expm" or "eigh"
+            processes (int) : number of worker processes (1 runs the grid in this process)
+        Returns:
+            unitary (np.array) : final unitary of each grid point with the shape (*grid shape, dim, dim)
+        """
+        if self.sparse and processes != 1:
+            raise ValueError(f'Sweep on the process pool requires the dense backend.')
+        names = list(grid.keys())
+        shape = tuple(len(grid[name]) for name in names)
+        points = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+        if processes == 1:
+            # the points are run on a shallow copy, so the registered sequence and results of this simulator are kept
+            sim = copy.copy(self)
+            unitary = [_sweep_point(sim, sequence_factory, params, step, engine) for params in points]
+            return np.array(unitary).reshape(shape + (self.dim, self.dim))
+
+        # the compiled operators are placed once in shared memory and attached by every worker
+        arrays = {"static_hamiltonian":self.static_hamiltonian, "operator_tensor":self.operator_tensor, "frame":self.frame}
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            layout[name] = (offset, np.shape(array))
+            offset += np.size(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1)*16)
+        try:
+            buffer = np.ndarray(offset, dtype=np.complex128, buffer=shm.buf)
+            for name, array in arrays.items():
+                start = layout[name][0]
+                buffer[start:start+np.size(array)] = np.ravel(array)
+            del buffer
+            meta = {"dim":self.dim, "operator_keys":self.operator_keys, "detunings":self.detunings,
+                    "stopflags":self.stopflags, "comp":self.comp, "static_blocks":self.static_blocks, "system_key":self.system_key}
+            with ProcessPoolExecutor(processes, initializer=_attach_sweep_worker, initargs=(shm.name, layout, meta)) as pool:
+                futures = [pool.submit(_sweep_worker_point, sequence_factory, params, step, engine) for params in points]
+                unitary = [future.result() for future in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+        return np.array(unitary).reshape(shape + (self.dim, self.dim))
+
+class BatchSimulator(Simulator):
+    """Class for computing the time-evolution of the batch of systems driven by the same pulse sequence,
+    such as for the Monte Carlo sampling of the fabrication disorder"""
+
+    def set_system(self, systems, frame_frequency=None, n_truncate=None, cache=None):
+        """register the batch of quantum systems to be simulated
+        Args:
+            systems (list) : classes for the target quantum systems with the same dimensions and drives
+            frame_frequency (float) : rotation frequency shared by the systems (default is the mean qubit frequency of the batch)
+            n_truncate (int) : maximum excitation number to be simulated
+            cache (bool or CompileCache) : cache of the compiled artefacts passed to System.compile
+        """
+        systems = list(systems)
+        if len(systems) == 0:
+            raise ValueError(f'Batch must contain at least one system.')
+        # the waveforms are shared, so every system is compiled on the same rotating frame
+        if frame_frequency is None:
+            frame_frequency = np.mean([q.frequency for system in systems for q in system.qubits.values()])
+        with self.stats.timer("system.compile"):
+            for system in systems:
+                system.compile(frame_frequency,n_truncate,False,cache)
+
+        reference = systems[0]
+        for i, system in enumerate(systems):
+            if system.dims != reference.dims:
+                raise ValueError(f'System {i} has the dimensions {system.dims} different from {reference.dims}.')
+            if list(system.dynamic_operators_on_frame.keys()) != list(reference.dynamic_operators_on_frame.keys()):
+                raise ValueError(f'System {i} has the drives different from the first system.')
+            for key, detuning in reference.dynamic_detunings.items():
+                if system.dynamic_stopflags[key] != reference.dynamic_stopflags[key] or not np.isclose(system.dynamic_detunings[key], detuning, rtol=0, atol=1e-12):
+                    raise ValueError(f'Drive {key} of system {i} has the detuning different from the first system.')
+
+        self.systems = systems
+        self.batch = len(systems)
+        self.sparse = False
+        self.dim = reference.dim
+        self.detunings = reference.dynamic_detunings
+        self.stopflags = reference.dynamic_stopflags
+        self.comp = reference.comp
+        self.operator_keys = list(reference.dynamic_operators_on_frame.keys())
+        self.static_hamiltonian = np.array([system.static_hamiltonian_on_frame for system in systems], dtype=np.complex128)
+        self.operator_tensor = np.zeros([self.batch, 2*len(self.operator_keys), self.dim, self.dim], dtype=np.complex128)
+        for b, system in enumerate(systems):
+            for i, key in enumerate(self.operator_keys):
+                self.operator_tensor[b,2*i:2*i+2] = system.dynamic_operators_on_frame[key]
+        self.frame = np.array([system.frame_on_frame for system in systems], dtype=np.complex128)
+        self.static_eigen = np.linalg.eigh(self.static_hamiltonian)
+        self.frame_eigen = np.linalg.eigh(self.frame)
+
+    def set_cache(self, maxsize=4096):
+        """the step propagator cache is not supported, every step of the batch is exponentiated by the batched eigh engine"""
+        raise ValueError(f'Propagator cache is not supported by BatchSimulator.')
+
+    def set_lut(self, resolution=1e-4, maxsize=65536):
+        """the lookup table engine is not supported, every step of the batch is exponentiated by the batched eigh engine"""
+        raise ValueError(f'Lookup table engine is not supported by BatchSimulator.')
+
+    def stream(self, engine="eigh", decimation=1, chunk=1024, integrator="midpoint"):
+        """streaming is not supported, run with chunk bounds the memory of the exponentiated steps instead"""
+        raise ValueError(f'Streaming is not supported by BatchSimulator.')
+
+    def gradient(self, target=None):
+        """gradients are not supported, compute them per system with Simulator.gradient"""
+        raise ValueError(f'Gradient is not supported by BatchSimulator.')
+
+    def sweep(self, sequence_factory, grid, step=0.1, engine="eigh", processes=None):
+        """parameter sweeps are not supported, run the batch on each sequence instead"""
+        raise ValueError(f'Sweep is not supported by BatchSimulator.')
 
+    def _batch_hamiltonians(self, coefficients):
+        """assemble the hamiltonians of every system from the waveform coefficients
+        Args:
+            coefficients (np.array) : waveform coefficients with the shape (..., n_ops)
+        Returns:
+            hamiltonians (np.array) : stacked hamiltonians with the shape (batch, ..., dim, dim)
+        """
+        hamiltonians = np.moveaxis(np.tensordot(coefficients, self.operator_tensor, axes=([-1],[1])), -3, 0)
+        hamiltonians += self.static_hamiltonian.reshape((self.batch,) + (1,)*(coefficients.ndim-1) + (self.dim, self.dim))
+        return hamiltonians
+
+    def _batch_step_propagators(self, s_list, c_list, integrator):
+        """compute the propagator of each step for every system
+        Args:
+            s_list (np.array) : width of each step
+            c_list (np.array) : waveform coefficients of each step with the shape (n_steps, n_ops),
+                or (n_steps, 2, n_ops) at the gauss nodes for the fourth-order integrators
+            integrator (str) : "midpoint", "magnus4" or "cf4"
+        Returns:
+            steps (np.array) : stacked step propagators with the shape (batch, n_steps, dim, dim)
+        """
+        steps = np.empty([self.batch, s_list.size, self.dim, self.dim], dtype=np.complex128)
+        idle = ~c_list.any(axis=tuple(range(1, c_list.ndim)))
+        if idle.any():
+            val, vec = self.static_eigen
+            phase = np.exp(-1j*val[:,None,:]*s_list[idle][None,:,None])
+            steps[:,idle] = (vec[:,None]*phase[:,:,None,:])@vec[:,None].conj().swapaxes(-1,-2)
+            self.stats.count("idle_steps", int(idle.sum()))
+        if idle.all():
+            return steps
+
+        s_driven = s_list[~idle]
+        h_list = self._batch_hamiltonians(c_list[~idle])
+        self.stats.count("expm", self.batch*s_driven.size*(2 if integrator == "cf4" else 1))
+        if integrator == "magnus4":
+            h_list = magnus4_hamiltonian(h_list[:,:,0], h_list[:,:,1], s_driven)
+        if integrator == "cf4":
+            first, second = cf4_hamiltonians(h_list[:,:,0], h_list[:,:,1])
+            steps[:,~idle] = expm_hermitian(second, s_driven)@expm_hermitian(first, s_driven)
+            return steps
+        steps[:,~idle] = expm_hermitian(h_list, s_driven)
+        return steps
+
+    @timed("run")
+    def run(self, return_all=True, integrator="midpoint", chunk=None):
+        """run the simulation of every system of the batch with the batched eigh engine
+        Args:
+            return_all (bool) : whether to return the simulation results during pulse execution
+            integrator (str) : "midpoint", "magnus4" or "cf4"
+            chunk (int) : number of steps exponentiated at once for the whole batch (default keeps about 2**20 matrix elements per chunk)
+
+        self.unitary has the shape (batch, T, dim, dim) if return_all, otherwise (batch, dim, dim).
+        """
+        if integrator == "split":
+            raise ValueError(f'Integrator split is not supported by BatchSimulator.')
+        self._check_integrator(integrator)
+        if chunk is None:
+            chunk = max(1, 2**20//(self.batch*self.dim*self.dim))
+
+        i_list, s_list, c_list = self._precompile(return_all, integrator)
+        u = np.array(np.broadcast_to(np.identity(self.dim, dtype=np.complex128), (self.batch, self.dim, self.dim)))
+        if return_all:
+            unitary = np.empty([self.batch, s_list.size+1, self.dim, self.dim], dtype=np.complex128)
+            unitary[:,0] = u
+        for start in range(0, s_list.size, chunk):
+            stop = min(start + chunk, s_list.size)
+            with self.stats.timer("exponentiate"):
+                steps = self._batch_step_propagators(s_list[start:stop], c_list[start:stop], integrator)
+            with self.stats.timer("accumulate"):
+                for k in range(stop - start):
+                    u = steps[:,k]@u
+                    if return_all:
+                        unitary[:,start+k+1] = u
+
+        val, vec = self.frame_eigen
+        with self.stats.timer("frame_rotation"):
             if return_all:
-                return unitary
+                t_list = np.concatenate([[0], np.cumsum(s_list)])
+                for start in range(0, t_list.size, chunk):
+                    stop = min(start + chunk, t_list.size)
+                    phase = np.exp(+1j*val[:,None,:]*t_list[None,start:stop,None])
+                    f = (vec[:,None]*phase[:,:,None,:])@vec[:,None].conj().swapaxes(-1,-2)
+                    unitary[:,start:stop] = f@unitary[:,start:stop]
+                self.unitary = unitary
             else:
-                t = sum(s_list)
-                f = lin.expm(+1j*frame*t)
-                return f@u
+                phase = np.exp(+1j*val*s_list.sum())
+                self.unitary = (vec*phase[:,None,:])@vec.conj().swapaxes(-1,-2)@u
+        self.stats.count("trajectory_bytes", self.unitary.nbytes)
+
+_sweep_shm = None
+_sweep_simulator = None
+
+def _attach_sweep_worker(name, layout, meta):
+    """build the simulator of the worker process on the shared compiled operators"""
+    global _sweep_shm, _sweep_simulator
+    _sweep_shm = shared_memory.SharedMemory(name=name)
+    size = sum(int(np.prod(shape)) for _, shape in layout.values())
+    buffer = np.ndarray(size, dtype=np.complex128, buffer=_sweep_shm.buf)
+
+    sim = Simulator()
+    for key, (start, shape) in layout.items():
+        setattr(sim, key, buffer[start:start+int(np.prod(shape))].reshape(shape))
+    for key, val in meta.items():
+        setattr(sim, key, val)
+    sim.operators = {key:sim.operator_tensor[2*i:2*i+2] for i, key in enumerate(sim.operator_keys)}
+    _sweep_simulator = sim
+
+def _sweep_worker_point(sequence_factory, params, step, engine):
+    return _sweep_point(_sweep_simulator, sequence_factory, params, step, engine)
 
-        t_list, s_list, h_list = precompile(2*np.pi*self.time, ith_hamiltonian)
-        self.unitary = time_evolution(s_list, h_list, self.frame)
\ No newline at end of file
+def _sweep_point(sim, sequence_factory, params, step, engine):
+    """simulate one grid point of the sweep"""
+    sequence = sequence_factory(**params)
+    detunings = None
+    if isinstance(sequence, tuple):
+        sequence, detunings = sequence
+    sim.set_sequence(sequence, step=step, detunings=detunings)
+    sim.run(return_all=False, engine=engine)
+    return sim.unitary
@@ -1,10 +1,21 @@
+import os
+import hashlib
 import itertools
 import numpy as np
 import scipy.sparse as sp
 from .util.transform import qubitize
-from .util.tensor_product import TensorProduct
+from .util.tensor_product import TensorProduct, SparseTensorProduct, subspace_operator
 from .util.frame import get_system_dressed_frame
 from .util.leakage import get_computational_basis
+from .util.cache import CompileCache
+
+COMPILE_CACHE_VERSION = 2
+COMPILED_ATTRIBUTES = [
+    "frame_frequency", "sparse", "dims", "dim", "label", "manifold",
+    "static_hamiltonian", "dynamic_operators", "dynamic_detunings", "dynamic_stopflags",
+    "conv", "frame", "comp", "static_hamiltonian_on_frame", "dynamic_operators_on_frame", "frame_on_frame", "truncation", "blocks",
+]
+compile_cache = CompileCache(os.environ.get("PULSE_SIMULATOR_CACHE_DIR"))
 
 class Qubit:
     """Class for standard harmonic oscillator"""
@@ -211,6 +222,8 @@ class System:
         self.qubits = {}
         self.coupls = {}
         self.drives = {}
+        self.compiled_static = None
+        self.compiled_drives = {}
               
     def __repr__(self):
         print_str  = "#"*25 + "Pulse Simulator".center(20) + "#"*25 + "\n"
@@ -289,15 +302,112 @@ class System:
             raise ValueError(f'Qubit {qubit} is not found.')
         self.drives[idx] = Flux(idx, self.qubits[qubit], amplitude)
 
-    def compile(self, frame_frequency=None, n_truncate=None):
+    def update_drive(self, idx, amplitude=None, frequency=None):
+        """retune a registered microwave drive or flux drive (only this drive is recompiled by the next compile)
+        Args:
+            idx (int) : index of the drive
+            amplitude (float) : new drive amplitude (None keeps the current one)
+            frequency (float) : new drive frequency (None keeps the current one, not available for the flux drive)
+        """
+        if idx not in self.drives.keys():
+            raise ValueError(f'Drive {idx} is not found.')
+        d = self.drives[idx]
+        if isinstance(d, Flux):
+            if frequency is not None:
+                raise ValueError(f'Flux drive {idx} has no frequency.')
+            if amplitude is not None:
+                self.drives[idx] = Flux(idx, d.qubit, amplitude)
+        else:
+            amplitude = d.amplitude if amplitude is None else amplitude
+            frequency = d.frequency if frequency is None else frequency
+            self.drives[idx] = Drive(idx, d.qubit, amplitude, frequency)
+
+    def cache_key(self, frame_frequency, n_truncate=None, sparse=False):
+        """return the stable hash of the system configuration used by the compile cache
+        Args:
+            frame_frequency (float) : rotation frequency of the system simulating the time evolution
+            n_truncate (int) : maximum excitation number to be simulated
+            sparse (bool) : whether to build the operators as scipy.sparse csr matrices
+        Returns:
+            key (str) : hex digest of the configuration
+        """
+        config = [COMPILE_CACHE_VERSION, float(frame_frequency), n_truncate, bool(sparse)]
+        config += self._static_config()
+        for idx, d in self.drives.items():
+            config.append((type(d).__name__, idx) + self._drive_config(idx)[1:])
+        key = hashlib.sha1(repr(config).encode()).hexdigest()
+        return key
+
+    def _static_config(self):
+        """return the parameters of the qubits and the couplings entering the static hamiltonian
+        Returns:
+            config (list) : tuple of the parameters of each qubit and coupling
+        """
+        config = []
+        for idx, q in self.qubits.items():
+            anharmonicity = None if q.anharmonicity is None else float(q.anharmonicity)
+            config.append(("qubit", idx, q.dim, float(q.frequency), anharmonicity))
+        for idxs, c in self.coupls.items():
+            config.append(("coupling", tuple(idxs), float(c.coupling)))
+        return config
+
+    def _drive_config(self, idx):
+        """return the parameters of the drive entering its compiled operators
+        Args:
+            idx (int) : index of the drive
+        Returns:
+            config (tuple) : (type name, qubit index, qubit dimension, amplitude, frequency)
+        """
+        d = self.drives[idx]
+        return (type(d).__name__, d.qubit.idx, d.qubit.dim, float(d.amplitude), float(d.frequency))
+
+    def compile(self, frame_frequency=None, n_truncate=None, sparse=False, cache=None):
         """compute the system time-evolution
         Args:
             frame_frequency (float) : rotation frequency of the system simulating the time evolution
+            n_truncate (int) : maximum excitation number to be simulated
+            sparse (bool) : whether to build the operators as scipy.sparse csr matrices
+            cache (bool or CompileCache) : cache of the compiled artefacts (True uses the module-level compile_cache,
+                which is also kept on disk if PULSE_SIMULATOR_CACHE_DIR is set)
         """
         
         if frame_frequency is None:
             frame_frequency = np.mean([q.frequency for q in self.qubits.values()])
+        if cache is True:
+            cache = compile_cache
+        static = (float(frame_frequency), n_truncate, bool(sparse), self._static_config())
+        drives = {idx:self._drive_config(idx) for idx in self.drives.keys()}
+        if cache:
+            key = self.cache_key(frame_frequency, n_truncate, sparse)
+            artefacts = cache.get(key)
+            if artefacts is not None:
+                for name, value in artefacts.items():
+                    setattr(self, name, value)
+                self.compiled_static = static
+                self.compiled_drives = drives
+                return
+
+        # drives do not enter the static hamiltonian, so their changes are applied on the compiled dressed frame
+        if self.compiled_static == static:
+            for idx in set(self.compiled_drives) - set(drives):
+                for compiled in (self.dynamic_operators, self.dynamic_operators_on_frame, self.dynamic_detunings, self.dynamic_stopflags):
+                    compiled.pop(idx, None)
+            for idx, config in drives.items():
+                previous = self.compiled_drives.get(idx)
+                if previous != config:
+                    frequency_only = previous is not None and previous[:-1] == config[:-1]
+                    self._compile_drive(idx, frequency_only)
+        else:
+            self._compile(frame_frequency, n_truncate, sparse)
+        self.compiled_static = static
+        self.compiled_drives = drives
+        if cache:
+            cache.put(key, {name:getattr(self, name) for name in COMPILED_ATTRIBUTES})
+
+    def _compile(self, frame_frequency, n_truncate, sparse):
+        """compute the static part and every drive from scratch"""
         self.frame_frequency = frame_frequency
+        self.sparse = sparse
         
         self.dims = [q.dim for q in self.qubits.values()]
         self.dim = np.prod(self.dims)
@@ -305,53 +415,115 @@ class System:
         self.manifold = {i:[] for i in range(sum(self.dims) - len(self.dims) + 1)}
         for i,l in enumerate(self.label):
             self.manifold[sum(l)].append(i)
-        
-        self.static_hamiltonian = 0
-        for idx, q in self.qubits.items():
-            tp = TensorProduct(*self.dims)
-            tp.prod(q.hamiltonian(frame_frequency), idx)
-            self.static_hamiltonian += tp.get_operator()
-        for idxs, c in self.coupls.items():
-            tp = TensorProduct(*self.dims)
-            tp.prod(c.hamiltonian(), idxs)
-            self.static_hamiltonian += tp.get_operator()
-            
-        self.dynamic_operators = {}
-        self.dynamic_detunings = {}
-        self.dynamic_stopflags = {}
-        for idx, d in self.drives.items():
-            tp = TensorProduct(*self.dims)
-            tp.prod(d.operator_real(), d.qubit.idx)
-            operator_real = tp.get_operator()
-            tp = TensorProduct(*self.dims)
-            tp.prod(d.operator_imag(), d.qubit.idx)
-            operator_imag = tp.get_operator()
-            self.dynamic_operators[idx] = (operator_real, operator_imag)
-            self.dynamic_detunings[idx] = d.frequency - frame_frequency
-            if isinstance(d, Drive):
-                self.dynamic_stopflags[idx] = False
-            if isinstance(d, Flux):
-                self.dynamic_stopflags[idx] = True
-            
-        self.conv, self.frame = get_system_dressed_frame(self)
+
+        # the truncated basis is built directly from the kept manifolds without the full space
+        self.truncation = None
+        self.blocks = [np.array(m) for m in self.manifold.values() if m]
+        if n_truncate is not None:
+            self.truncation = []
+            for i in range(n_truncate+1):
+                self.truncation += self.manifold[i]
+            full_label = self.label
+            self.dim = len(self.truncation)
+            self.label = np.array(full_label)[self.truncation]
+            sizes = [len(self.manifold[i]) for i in range(n_truncate+1)]
+            self.blocks = [b for b in np.split(np.arange(self.dim), np.cumsum(sizes)[:-1]) if b.size]
+
+        self.static_hamiltonian = self._static_operator()
+        outer_blocks = []
+        if self.truncation is not None:
+            compiled = set(map(tuple, self.label))
+            outer = {sum(l) for l in full_label if (2 not in l) and (l not in compiled)}
+            for i in sorted(outer):
+                label = np.array(full_label)[self.manifold[i]]
+                outer_blocks.append((label, self._static_operator(label)))
+
+        self.conv, self.frame = get_system_dressed_frame(self, outer_blocks)
         self.comp = get_computational_basis(self)
+        if sparse:
+            self.conv = sparsify(self.conv)
+            self.frame = sparsify(self.frame)
         
         # operator conversion onto the system dressed frame
         self.static_hamiltonian_on_frame = self.conv.T.conj()@self.static_hamiltonian@self.conv
-        self.dynamic_operators_on_frame = {}
-        for key, val in self.dynamic_operators.items():
-            self.dynamic_operators_on_frame[key] = self.conv.T.conj()@val@self.conv
         self.frame_on_frame = self.conv.T.conj()@self.frame@self.conv
+        if sparse:
+            self.static_hamiltonian_on_frame = sparsify(self.static_hamiltonian_on_frame)
+            self.frame_on_frame = sparsify(self.frame_on_frame)
 
-        if n_truncate is not None:
-            manifold = []
-            for i in range(n_truncate+1):
-                manifold += self.manifold[i]
-            self.dim = len(manifold)
-            self.label = np.array(self.label)[manifold]
-            self.static_hamiltonian_on_frame = self.static_hamiltonian_on_frame[np.ix_(manifold, manifold)]
-            new_dynamic_operators_on_frame = {}
-            for key, val in self.dynamic_operators_on_frame.items():
-                new_dynamic_operators_on_frame[key] = val[np.ix_(range(2), manifold, manifold)]
-            self.dynamic_operators_on_frame = new_dynamic_operators_on_frame
-            self.frame_on_frame = self.frame_on_frame[np.ix_(manifold, manifold)]
\ No newline at end of file
+        self.dynamic_operators = {}
+        self.dynamic_detunings = {}
+        self.dynamic_stopflags = {}
+        self.dynamic_operators_on_frame = {}
+        for idx in self.drives.keys():
+            self._compile_drive(idx)
+
+    def _embed(self, operator, target, label=None):
+        """embed the local operator into the compiled basis
+        Args:
+            operator (np.array) : matrix acting on the target
+            target (int or tuple) : index of the qubit (or qubits) on which the matrix acts
+            label (np.array) : labels of the basis states (default is the compiled basis)
+        Returns:
+            output (np.array or sp.csr_matrix) : matrix on the basis, sparse on the sparse backend
+        """
+        if label is None and self.truncation is None:
+            tp = (SparseTensorProduct if self.sparse else TensorProduct)(*self.dims)
+            tp.prod(operator, target)
+            return tp.get_operator()
+        output = subspace_operator(self.dims, self.label if label is None else label, operator, target)
+        if self.sparse and label is None:
+            output = sparsify(output)
+        return output
+
+    def _static_operator(self, label=None):
+        """compute the static hamiltonian on the basis
+        Args:
+            label (np.array) : labels of the basis states (default is the compiled basis)
+        Returns:
+            static_hamiltonian (np.array or sp.csr_matrix) : static hamiltonian on the basis
+        """
+        static_hamiltonian = 0
+        for idx, q in self.qubits.items():
+            static_hamiltonian += self._embed(q.hamiltonian(self.frame_frequency), idx, label)
+        for idxs, c in self.coupls.items():
+            static_hamiltonian += self._embed(c.hamiltonian(), idxs, label)
+        return static_hamiltonian
+
+    def _compile_drive(self, idx, frequency_only=False):
+        """compute the operators and the detuning of one drive on the compiled dressed frame
+        Args:
+            idx (int) : index of the drive
+            frequency_only (bool) : whether only the detuning has to be updated
+        """
+        d = self.drives[idx]
+        self.dynamic_detunings[idx] = d.frequency - self.frame_frequency
+        if isinstance(d, Drive):
+            self.dynamic_stopflags[idx] = False
+        if isinstance(d, Flux):
+            self.dynamic_stopflags[idx] = True
+        if frequency_only:
+            return
+
+        operator_real = self._embed(d.operator_real(), d.qubit.idx)
+        operator_imag = self._embed(d.operator_imag(), d.qubit.idx)
+        self.dynamic_operators[idx] = (operator_real, operator_imag)
+
+        if self.sparse:
+            val = tuple(sparsify(self.conv.T.conj()@v@self.conv) for v in self.dynamic_operators[idx])
+        else:
+            val = self.conv.T.conj()@self.dynamic_operators[idx]@self.conv
+        self.dynamic_operators_on_frame[idx] = val
+
+def sparsify(X, tol=1e-12):
+    """convert the matrix into a csr matrix dropping the numerically vanishing elements
+    Args:
+        X (np.array or sp.spmatrix) : input matrix
+        tol (float) : threshold on the absolute value of the elements to be kept
+    Returns:
+        Y (sp.csr_matrix) : sparse matrix
+    """
+    Y = sp.csr_matrix(X, dtype=np.complex128)
+    Y.data[abs(Y.data) < tol] = 0
+    Y.eliminate_zeros()
+    return Y
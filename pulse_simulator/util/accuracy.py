@@ -0,0 +1,45 @@
+import time
+import numpy as np
+
+def unitary_infidelity(u, v):
+    """compute the infidelity between two unitaries up to the global phase
+    Args:
+        u (np.array) : unitary matrix
+        v (np.array) : reference unitary matrix
+    Returns:
+        infidelity (float) : 1 - |tr(v^dag u)/dim|^2
+    """
+    infidelity = 1 - abs(np.trace(v.T.conj()@u)/u.shape[0])**2
+    return infidelity
+
+def integrator_accuracy(simulator, sequence, steps, integrators=("midpoint", "magnus4", "cf4"), reference_step=None, engine="eigh"):
+    """compare the final unitaries of the integrators at several step widths against a fine-step reference
+    Args:
+        simulator (Simulator) : simulator on which the system is already registered
+        sequence (Sequence) : class for the target pulse schedule (imported from sequence_parser)
+        steps (list) : time step widths to be compared (ns)
+        integrators (list) : integrators to be compared
+        reference_step (float) : time step width of the magnus4 reference (default is min(steps)/10)
+        engine (str) : "expm" or "eigh"
+    Returns:
+        infidelity (dict) : {integrator : np.array of the infidelity against the reference for each step width}
+        elapsed (dict) : {integrator : np.array of the run time for each step width (s)}
+    """
+    if reference_step is None:
+        reference_step = min(steps)/10
+    simulator.set_sequence(sequence, step=reference_step)
+    simulator.run(return_all=False, engine=engine, integrator="magnus4")
+    reference = simulator.unitary
+
+    infidelity = {integrator:[] for integrator in integrators}
+    elapsed = {integrator:[] for integrator in integrators}
+    for step in steps:
+        simulator.set_sequence(sequence, step=step)
+        for integrator in integrators:
+            start = time.perf_counter()
+            simulator.run(return_all=False, engine=engine, integrator=integrator)
+            elapsed[integrator].append(time.perf_counter() - start)
+            infidelity[integrator].append(unitary_infidelity(simulator.unitary, reference))
+    infidelity = {key:np.array(val) for key, val in infidelity.items()}
+    elapsed = {key:np.array(val) for key, val in elapsed.items()}
+    return infidelity, elapsed
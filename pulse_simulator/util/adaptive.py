@@ -0,0 +1,93 @@
+import numpy as np
+from scipy.interpolate import CubicSpline
+from .segment import precompile
+from .propagator import GAUSS_NODES, expm_hermitian, magnus4_hamiltonian
+
+def adaptive_evolution(time, waveforms, hamiltonians, tol=1e-8, output_time=None, max_factor=4.0):
+    """compute the time-evolution with the fourth-order magnus integrator and step-doubling error control
+    Args:
+        time (np.array) : sampling times with the shape (T,)
+        waveforms (np.array) : waveform matrix with the shape (n_ops, T)
+        hamiltonians (function) : function mapping the waveform coefficients (n, n_ops) to the stacked hamiltonians (n, dim, dim)
+        tol (float) : tolerance on the maximum element of the local error of each step
+        output_time (np.array) : sorted times at which the unitary is returned (default is only the final time)
+        max_factor (float) : maximum growth factor of the step width
+    Returns:
+        unitary (np.array) : unitaries at output_time with the shape (n_out, dim, dim)
+        n_steps (int) : number of accepted steps
+    """
+    if output_time is None:
+        output_time = time[-1:]
+    output_time = np.asarray(output_time, dtype=float)
+    if output_time.size and (output_time[0] < time[0] or output_time[-1] > time[-1]):
+        raise ValueError(f'Output times must be within the simulation time.')
+
+    dim = hamiltonians(np.zeros([1, waveforms.shape[0]])).shape[-1]
+    spline = CubicSpline(time, waveforms, axis=1) if time.size >= 4 else None
+    def coefficients(t):
+        if spline is None:
+            return np.array([np.interp(t, time, w) for w in waveforms]).T.reshape(-1, waveforms.shape[0])
+        return spline(t).T
+
+    def magnus(t0, h):
+        # stacked magnus steps starting at t0 with the widths h
+        t0, h = np.asarray(t0, dtype=float), np.asarray(h, dtype=float)
+        nodes = (t0[:,None] + GAUSS_NODES[None,:]*h[:,None]).ravel()
+        hs = hamiltonians(coefficients(nodes)).reshape(t0.size, 2, dim, dim)
+        return expm_hermitian(magnus4_hamiltonian(hs[:,0], hs[:,1], h), h)
+
+    # constant runs are exponentiated exactly, error control only acts on the varying stretches
+    i_list, s_list, c_list = precompile(time, waveforms, return_all=False)
+    pieces = []
+    for k in range(s_list.size):
+        start, end = time[i_list[k]], time[i_list[k+1]]
+        if i_list[k+1] - i_list[k] > 1:
+            pieces.append((start, end, c_list[k]))
+        elif pieces and pieces[-1][2] is None:
+            pieces[-1] = (pieces[-1][0], end, None)
+        else:
+            pieces.append((start, end, None))
+
+    u = np.identity(dim, dtype=np.complex128)
+    unitary = []
+    j = 0
+    while j < output_time.size and output_time[j] <= time[0]:
+        unitary.append(u)
+        j += 1
+
+    n_steps = 0
+    h = time[1] - time[0] if time.size > 1 else 0
+    for start, end, c in pieces:
+        t = start
+        while t < end:
+            if c is not None:
+                step, h_step = expm_hermitian(hamiltonians(c[None]), [end - t])[0], end - t
+            else:
+                h_step = min(h, end - t)
+                full, first, second = magnus([t, t, t + 0.5*h_step], [h_step, 0.5*h_step, 0.5*h_step])
+                step = second@first
+                err = np.abs(step - full).max()
+                factor = max_factor if err == 0 else min(max_factor, max(0.2, 0.9*(tol/err)**0.2))
+                if err > tol and h_step > 1e-9*(end - start):
+                    h = h_step*factor
+                    continue
+                h = h_step*factor
+
+            # outputs inside the accepted step are reached by a partial step from its start
+            while j < output_time.size and output_time[j] <= t + h_step:
+                tau = output_time[j] - t
+                if np.isclose(tau, h_step, rtol=0, atol=1e-12*max(1, abs(end))):
+                    unitary.append(step@u)
+                elif c is not None:
+                    unitary.append(expm_hermitian(hamiltonians(c[None]), [tau])[0]@u)
+                else:
+                    unitary.append(magnus([t], [tau])[0]@u)
+                j += 1
+            u = step@u
+            t = t + h_step
+            n_steps += 1
+
+    while j < output_time.size:
+        unitary.append(u)
+        j += 1
+    return np.array(unitary), n_steps
@@ -0,0 +1,352 @@
+import os
+import copy
+import types
+import copyreg
+import pickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+class PropagatorCache:
+    """Class for caching the step propagators with the least-recently-used eviction"""
+
+    def __init__(self, maxsize=4096):
+        """define the capacity of the cache
+        Args:
+            maxsize (int) : maximum number of the cached propagators (memory is about maxsize*dim*dim*16 bytes)
+        """
+        if maxsize < 1:
+            raise ValueError(f'Cache size must be set >= 1')
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        print_str = "-"*50 + "\n"
+        print_str += f"Propagator Cache \n"
+        print_str += "*" + f" Size          = {len(self.table)}/{self.maxsize} \n"
+        print_str += "*" + f" Hits          = {self.hits} \n"
+        print_str += "*" + f" Misses        = {self.misses} \n"
+        print_str += "*" + f" Evictions     = {self.evictions} \n"
+        print_str += "-"*50
+        return print_str
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __len__(self):
+        return len(self.table)
+
+    def info(self):
+        """return the statistics of the cache
+        Returns:
+            info (dict) : hits, misses, evictions and current size of the cache
+        """
+        return {"hits":self.hits, "misses":self.misses, "evictions":self.evictions, "size":len(self.table), "maxsize":self.maxsize}
+
+    def clear(self):
+        """drop all the cached propagators and reset the statistics"""
+        self.table.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, key, value):
+        """register the propagator and evict the least-recently-used one if full
+        Args:
+            key (hashable) : content address of the propagator
+            value (np.array) : propagator to be cached
+        """
+        # views into a batch would keep the whole batch alive, so the cache owns a copy
+        self.table[key] = np.array(value)
+        self.table.move_to_end(key)
+        while len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(self, keys, compute):
+        """return the propagators for the keys, computing all the missing ones at once
+        Args:
+            keys (list) : content addresses of the propagators
+            compute (function) : function mapping the list of positions in keys to the stacked propagators
+        Returns:
+            values (np.array) : stacked propagators in the order of keys
+        """
+        found = {}
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in found or key in missing:
+                self.hits += 1
+            elif key in self.table:
+                self.hits += 1
+                self.table.move_to_end(key)
+                found[key] = self.table[key]
+            else:
+                self.misses += 1
+                missing[key] = i
+
+        if missing:
+            computed = compute(list(missing.values()))
+            for key, value in zip(missing.keys(), computed):
+                found[key] = value
+                self.put(key, value)
+
+        values = np.array([found[key] for key in keys])
+        return values
+
+class CompileCache:
+    """Class for caching the compiled artefacts of System in memory and on disk"""
+
+    def __init__(self, directory=None, maxsize=64):
+        """define the storage of the cache
+        Args:
+            directory (str) : directory of the pickled artefacts on disk (None keeps them only in memory)
+            maxsize (int) : maximum number of the artefacts kept in memory
+        """
+        if maxsize < 1:
+            raise ValueError(f'Cache size must be set >= 1')
+        self.directory = directory
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        print_str = "-"*50 + "\n"
+        print_str += f"Compile Cache \n"
+        print_str += "*" + f" Directory     = {self.directory} \n"
+        print_str += "*" + f" Size          = {len(self.table)}/{self.maxsize} \n"
+        print_str += "*" + f" Hits          = {self.hits} (disk {self.disk_hits}) \n"
+        print_str += "*" + f" Misses        = {self.misses} \n"
+        print_str += "-"*50
+        return print_str
+
+    def __str__(self):
+        return self.__repr__()
+
+    def info(self):
+        """return the statistics of the cache
+        Returns:
+            info (dict) : hits, disk hits, misses and current size of the cache
+        """
+        return {"hits":self.hits, "disk_hits":self.disk_hits, "misses":self.misses, "size":len(self.table), "maxsize":self.maxsize}
+
+    def clear(self, disk=False):
+        """drop the artefacts kept in memory
+        Args:
+            disk (bool) : whether to delete the artefacts on disk too
+        """
+        self.table.clear()
+        if disk and self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith(".pkl"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def get(self, key):
+        """return a copy of the artefacts registered with the key
+        Args:
+            key (str) : stable hash of the system configuration
+        Returns:
+            artefacts (dict) : {attribute name : value} or None if not found
+        """
+        if key in self.table:
+            self.hits += 1
+            self.table.move_to_end(key)
+            return copy.deepcopy(self.table[key])
+        if self.directory is not None:
+            path = os.path.join(self.directory, f"{key}.pkl")
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    artefacts = pickle.load(f)
+                self.hits += 1
+                self.disk_hits += 1
+                self._store(key, artefacts)
+                return copy.deepcopy(artefacts)
+        self.misses += 1
+        return None
+
+    def put(self, key, artefacts):
+        """register the artefacts in memory and on disk
+        Args:
+            key (str) : stable hash of the system configuration
+            artefacts (dict) : {attribute name : value}
+        """
+        artefacts = copy.deepcopy(artefacts)
+        self._store(key, artefacts)
+        if self.directory is not None:
+            path = os.path.join(self.directory, f"{key}.pkl")
+            with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+                pickle.dump(artefacts, f)
+            os.replace(f.name, path)
+
+    def _store(self, key, artefacts):
+        self.table[key] = artefacts
+        self.table.move_to_end(key)
+        while len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+
+PORT_ATTRIBUTES = {"if_freq", "DAC_STEP", "waveform", "time"}
+
+class SequenceCache:
+    """Class for caching the compiled waveforms of the pulse sequences with the least-recently-used eviction"""
+
+    def __init__(self, maxsize=16):
+        """define the capacity of the cache
+        Args:
+            maxsize (int) : maximum number of the cached sequences
+        """
+        if maxsize < 1:
+            raise ValueError(f'Cache size must be set >= 1')
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        print_str = "-"*50 + "\n"
+        print_str += f"Sequence Cache \n"
+        print_str += "*" + f" Size          = {len(self.table)}/{self.maxsize} \n"
+        print_str += "*" + f" Hits          = {self.hits} \n"
+        print_str += "*" + f" Misses        = {self.misses} \n"
+        print_str += "-"*50
+        return print_str
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __len__(self):
+        return len(self.table)
+
+    def info(self):
+        """return the statistics of the cache
+        Returns:
+            info (dict) : hits, misses and current size of the cache
+        """
+        return {"hits":self.hits, "misses":self.misses, "size":len(self.table), "maxsize":self.maxsize}
+
+    def clear(self):
+        """drop all the cached sequences and reset the statistics"""
+        self.table.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, sequence, if_freqs, step):
+        """return the key of the compiled sequence
+        Args:
+            sequence (Sequence) : pulse schedule (identified by the fingerprint of its content, so in-place edits change the key)
+            if_freqs (dict) : {port name : if frequency} applied to the ports
+            step (float) : time step width (ns)
+        Returns:
+            key (tuple) : key of the cache, or None if the sequence holds an object that cannot be fingerprinted (not cached)
+        """
+        # the ports are set up and compiled by the simulator, so their settings and outputs are left to if_freqs and step
+        exclude = {id(port):PORT_ATTRIBUTES for port in sequence.port_list}
+        try:
+            content = fingerprint(sequence, exclude)
+        except ValueError:
+            return None
+        return (content, tuple(sorted(if_freqs.items(), key=lambda item: str(item[0]))), float(step))
+
+    def get(self, key):
+        """return the compiled waveforms registered with the key
+        Args:
+            key (tuple) : key returned by self.key
+        Returns:
+            compiled (dict) : {"waveforms", "time", "trigger_position_list"} or None if not found
+        """
+        if key is not None and key in self.table:
+            self.hits += 1
+            self.table.move_to_end(key)
+            return self.table[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, compiled):
+        """register the compiled waveforms
+        Args:
+            key (tuple) : key returned by self.key
+            compiled (dict) : {"waveforms", "time", "trigger_position_list"}
+        """
+        if key is None:
+            return
+        self.table[key] = compiled
+        self.table.move_to_end(key)
+        while len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+
+def fingerprint(obj, exclude=None):
+    """return the hash of the content of the object, walking its attributes, containers, arrays and closures
+    Args:
+        obj (object) : object to be fingerprinted such as a pulse schedule
+        exclude (dict) : {id of an object : attribute names left out of the hash}
+    Returns:
+        key (str) : hex digest of the content
+
+    Objects other than the containers, arrays and functions are hashed by their pickle reduction,
+    and ValueError is raised for the objects that cannot be pickled.
+    """
+    h = hashlib.sha1()
+    _update_fingerprint(h, obj, {}, exclude or {})
+    return h.hexdigest()
+
+def _update_fingerprint(h, obj, visited, exclude):
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update(repr((type(obj).__name__, obj)).encode())
+        return
+    if id(obj) in visited:
+        # shared and cyclic references are recorded by the order of the first visit
+        h.update(f"ref{visited[id(obj)][0]}".encode())
+        return
+    # the object is held so that the ids of the temporary containers are not reused during the walk
+    visited[id(obj)] = (len(visited), obj)
+    h.update(type(obj).__qualname__.encode())
+    if isinstance(obj, np.ndarray):
+        h.update(repr((obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            _update_fingerprint(h, key, visited, exclude)
+            _update_fingerprint(h, value, visited, exclude)
+    elif isinstance(obj, (list, tuple)):
+        h.update(str(len(obj)).encode())
+        for value in obj:
+            _update_fingerprint(h, value, visited, exclude)
+    elif isinstance(obj, (set, frozenset)):
+        for value in sorted(obj, key=repr):
+            _update_fingerprint(h, value, visited, exclude)
+    elif isinstance(obj, types.FunctionType):
+        h.update(obj.__code__.co_code)
+        _update_fingerprint(h, obj.__code__.co_consts, visited, exclude)
+        _update_fingerprint(h, obj.__defaults__, visited, exclude)
+        _update_fingerprint(h, [cell.cell_contents for cell in obj.__closure__ or ()], visited, exclude)
+    elif isinstance(obj, type):
+        h.update(f"{obj.__module__}.{obj.__qualname__}".encode())
+    else:
+        # the pickle reduction holds the attributes, the slots and the state of the extension types,
+        # whereas repr(obj) would only give the address of the object
+        reducer = copyreg.dispatch_table.get(type(obj))
+        try:
+            reduced = obj.__reduce_ex__(4) if reducer is None else reducer(obj)
+        except Exception:
+            raise ValueError(f'Object of the type {type(obj).__qualname__} cannot be fingerprinted.')
+        if isinstance(reduced, str):
+            h.update(reduced.encode())
+            return
+        reduced = [list(item) if hasattr(item, "__next__") else item for item in reduced]
+        if id(obj) in exclude and len(reduced) > 2:
+            reduced[2] = _without(reduced[2], exclude[id(obj)])
+        _update_fingerprint(h, tuple(reduced), visited, exclude)
+
+def _without(state, names):
+    """drop the attributes from the pickled state, which is the instance dict or the pair of the dict and the slots"""
+    if isinstance(state, dict):
+        return {name:value for name, value in state.items() if name not in names}
+    if isinstance(state, tuple) and len(state) == 2:
+        return tuple(_without(part, names) if isinstance(part, dict) else part for part in state)
+    return state
@@ -0,0 +1,106 @@
+import numpy as np
+
+def computational_block(u, sys):
+    """extract the computational block of the unitaries with one fancy index
+    Args:
+        u (np.array) : unitary with the shape (dim, dim), or stacked unitaries with the shape (..., dim, dim) such as a memmap trajectory
+        sys (System) : class for the target quantum system
+    Returns:
+        block (np.array) : computational block with the shape (..., n_comp, n_comp)
+    """
+    comp = np.asarray(sys.comp)
+    block = u[...,comp[:,None],comp[None,:]]
+    return block
+
+def average_gate_fidelity(u, target, sys=None):
+    """compute the average gate fidelity against the target unitary, the leakage lowers the fidelity
+    Args:
+        u (np.array) : unitary with the shape (dim, dim), or stacked unitaries with the shape (..., dim, dim)
+        target (np.array) : target unitary on the computational subspace (on the full space if sys is None)
+        sys (System) : class for the target quantum system (None compares the full unitaries)
+    Returns:
+        fidelity (float or np.array) : average gate fidelity of each unitary
+    """
+    m = np.asarray(u) if sys is None else computational_block(u, sys)
+    target = np.asarray(target)
+    d = target.shape[0]
+    # F = (tr(M^dag M) + |tr(V^dag M)|^2)/(d(d+1)) holds also for the non-unitary block M
+    overlap = np.einsum("ij,...ij->...", target.conj(), m)
+    norm = np.einsum("...ij,...ij->...", m.conj(), m).real
+    fidelity = (norm + abs(overlap)**2)/(d*(d + 1))
+    return fidelity
+
+def virtual_z_fidelity(u, target, sys, n_sweep=5, n_iter=50, tol=1e-10, n_start=64, seed=0):
+    """compute the average gate fidelity after the optimal virtual Z rotations before and after the gate
+    Args:
+        u (np.array) : unitary with the shape (dim, dim), or stacked unitaries with the shape (..., dim, dim)
+        target (np.array) : target unitary on the computational subspace
+        sys (System) : class for the target quantum system
+        n_sweep (int) : number of sweeps of the coordinate ascent locating the optimal phases
+        n_iter (int) : maximum number of saddle-free newton iterations refining the phases
+        tol (float) : tolerance on the gradient of |tr(V^dag M)|^2 to stop the newton iterations
+        n_start (int) : number of starting phases (zero phases and n_start-1 random ones) swept by the coordinate ascent,
+            the best of them is refined by the newton iterations
+        seed (int) : seed of the random starting phases
+    Returns:
+        fidelity (float or np.array) : corrected average gate fidelity of each unitary
+        pre (np.array) : phase of each qubit applied before the gate with the shape (..., n_qubit)
+        post (np.array) : phase of each qubit applied after the gate with the shape (..., n_qubit)
+
+    The corrected block is Z(post)@M@Z(pre) with Z(phi) = diag(exp(-1j*label@phi)) on the computational labels.
+    The overlap has local maxima in the phases, so the optimum is searched from several starting points
+    (the global one is found unless all n_start starts miss its basin).
+    """
+    m = computational_block(u, sys)
+    target = np.asarray(target)
+    d = target.shape[0]
+    label = np.array(sys.label)[np.asarray(sys.comp)]
+    n_qubit = label.shape[1]
+    w = target.conj()*m
+    norm = np.einsum("...ij,...ij->...", m.conj(), m).real
+
+    # generators of the phases (post phases act on the rows, pre phases on the columns)
+    generator = np.concatenate([np.broadcast_to(label.T[:,:,None], (n_qubit, d, d)),
+                                np.broadcast_to(label.T[:,None,:], (n_qubit, d, d))]).astype(float)
+    def rotated(theta):
+        return w*np.exp(-1j*np.tensordot(theta, generator, axes=1))
+
+    # the overlap has several local maxima in the phases, so the starting points are swept at once along a leading axis
+    theta = np.random.default_rng(seed).uniform(-np.pi, np.pi, (n_start,) + m.shape[:-2] + (2*n_qubit,))
+    theta[0] = 0
+    for _ in range(n_sweep):
+        # the overlap is c0 + c1*exp(-1j*delta) in each phase, so every coordinate step is solved exactly
+        for k in range(2*n_qubit):
+            terms = rotated(theta)
+            c1 = (terms*generator[k]).sum((-1,-2))
+            c0 = terms.sum((-1,-2)) - c1
+            theta[...,k] += np.angle(c1) - np.angle(c0)
+
+    # only the best basin found by the coordinate ascent is refined by the newton iterations
+    overlap = rotated(theta).sum((-1,-2))
+    best = abs(overlap).argmax(axis=0)
+    overlap = np.take_along_axis(overlap, best[None], axis=0)[0]
+    theta = np.take_along_axis(theta, best[None,...,None], axis=0)[0]
+    scale = np.ones(overlap.shape)
+    for _ in range(n_iter):
+        terms = rotated(theta)
+        first = -1j*np.einsum("kij,...ij->...k", generator, terms)
+        second = -np.einsum("kij,lij,...ij->...kl", generator, generator, terms)
+        grad = 2*(overlap.conj()[...,None]*first).real
+        if np.all(abs(grad) < tol):
+            break
+        hess = 2*(first.conj()[...,:,None]*first[...,None,:] + overlap.conj()[...,None,None]*second).real
+        # saddle-free newton step, the curvature is taken as -|eigenvalue| so that every step goes uphill
+        val, vec = np.linalg.eigh(hess)
+        curvature = np.maximum(abs(val), 1e-6*abs(val).max(-1, keepdims=True) + 1e-300)
+        step = np.einsum("...kl,...l->...k", vec, np.einsum("...lk,...l->...k", vec, grad)/curvature)*scale[...,None]
+        candidate = rotated(theta + step).sum((-1,-2))
+        # steps away from the maximum are retried with the halved length
+        accept = abs(candidate) >= abs(overlap)
+        theta = np.where(accept[...,None], theta + step, theta)
+        overlap = np.where(accept, candidate, overlap)
+        scale = np.where(accept, np.minimum(2*scale, 1), 0.5*scale)
+
+    fidelity = (norm + abs(overlap)**2)/(d*(d + 1))
+    post, pre = theta[...,:n_qubit], theta[...,n_qubit:]
+    return fidelity, pre, post
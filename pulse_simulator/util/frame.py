@@ -1,5 +1,6 @@
-import itertools
 import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import linear_sum_assignment
 from .tensor_product import TensorProduct
 
 # def get_system_dressed_frame(sys): # perturbation
@@ -34,29 +35,60 @@ from .tensor_product import TensorProduct
         
 #     return system_basis, system_frame
 
-def get_system_dressed_frame(sys): # numerical
-    val, vec = np.linalg.eig(sys.static_hamiltonian)
+def dressed_states(hamiltonian):
+    """diagonalize one block of the static hamiltonian and order the dressed states by their dominant bare state
+    Args:
+        hamiltonian (np.array) : hermitian matrix of the block
+    Returns:
+        val (np.array) : dressed energies
+        vec (np.array) : dressed states as columns with their dominant component real and positive
+    """
+    val, vec = np.linalg.eigh(hamiltonian)
+    # one-to-one assignment maximizing the total overlap, hybridized states never share a bare state
+    _, order = linear_sum_assignment(abs(vec)**2, maximize=True)
+    val, vec = val[order], vec[:,order]
+    dominant = np.diag(vec)
+    vec = vec*(abs(dominant)/dominant)[None,:]
+    return val, vec
 
-    idx_list = []
-    for i in vec.T:
-        idx = np.argmax(abs(i)**2)
-        idx_list.append(idx)
-    idx_list = np.array(idx_list)
+def get_system_dressed_frame(sys, outer_blocks=()): # numerical
+    """diagonalize the static hamiltonian block by block over the excitation manifolds
+    Args:
+        sys (System) : class for the target quantum system with the compiled static hamiltonian, label and blocks
+        outer_blocks (list) : list of (label, hamiltonian) of the manifolds outside the compiled basis,
+            only their energies are used for the qubit frequencies
+    Returns:
+        conv (np.array or sp.csr_matrix) : dressed states as columns, sparse if the static hamiltonian is sparse
+        frame (np.array or sp.csr_matrix) : generator of the system dressed frame
+    """
+    static_hamiltonian = sys.static_hamiltonian
+    is_sparse = sp.issparse(static_hamiltonian)
+    if is_sparse:
+        static_hamiltonian = static_hamiltonian.tocsr()
 
-    vec = vec.T[np.argsort(idx_list)]
-    val = val[np.argsort(idx_list)]
-    
-    # V = vec
-    # E = np.diag(val)
-    # H = V.T@E@V.conj()
-    # np.allclose(H, sys.static_hamiltonian) = True
+    # the exchange coupling conserves the excitation number, so the manifolds never mix
+    val = np.zeros(sys.dim)
+    rows, cols, data = [], [], []
+    for block in sys.blocks:
+        h = static_hamiltonian[block][:,block]
+        h = h.toarray() if is_sparse else h
+        v, w = dressed_states(h)
+        val[block] = v
+        r, c = np.meshgrid(block, block, indexing="ij")
+        rows.append(r.ravel())
+        cols.append(c.ravel())
+        data.append(w.ravel())
+    conv = sp.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(sys.dim, sys.dim))
 
-    label = list(itertools.product(*[range(d) for d in sys.dims]))
+    energy = {tuple(l):v for l, v in zip(sys.label, val)}
+    for label, hamiltonian in outer_blocks:
+        v, _ = dressed_states(hamiltonian)
+        energy.update({tuple(l):e for l, e in zip(label, v)})
 
     qfreqs = {} # on rotating frame
     for q in sys.qubits.keys():
         qfreqs[q] = 0
-        for i,j in zip(label, val):
+        for i,j in energy.items():
             if i[q] == 0 and (2 not in i):
                 qfreqs[q] -= j
             if i[q] == 1 and (2 not in i):
@@ -64,14 +96,13 @@ def get_system_dressed_frame(sys): # numerical
         qfreqs[q] *= 0.5
 
     qenergy = []
-    for l in label:
+    for l in sys.label:
         tmp = 0
         for q in sys.qubits.keys():
             tmp += l[q]*qfreqs[q]
         qenergy.append(tmp)
-    
-    conv = vec.T
-    frame = conv@np.diag(qenergy)@conv.T.conj()
-    
+
+    frame = conv@sp.diags(qenergy)@conv.T.conj()
+    if not is_sparse:
+        conv, frame = conv.toarray(), frame.toarray()
     return conv, frame
-    
\ No newline at end of file
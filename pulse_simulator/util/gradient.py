@@ -0,0 +1,73 @@
+import numpy as np
+
+def expm_derivative_kernel(val, s):
+    """compute the divided differences of exp(-1j*val*s) in the Daleckii-Krein formula
+    Args:
+        val (np.array) : eigenvalues of the step hamiltonians with the shape (T, dim)
+        s (np.array) : time step widths with the shape (T,)
+    Returns:
+        kernel (np.array) : kernel with the shape (T, dim, dim) such that the derivative of exp(-1j*H*s) along dH
+            is vec@(kernel*(vec^dag@dH@vec))@vec^dag
+    """
+    s = np.asarray(s)[:,None,None]
+    mean = 0.5*(val[:,:,None] + val[:,None,:])
+    diff = val[:,:,None] - val[:,None,:]
+    # (exp(-1j*a*s) - exp(-1j*b*s))/(a - b) written without the cancellation for the close eigenvalues
+    kernel = -1j*s*np.exp(-1j*mean*s)*np.sinc(diff*s/(2*np.pi))
+    return kernel
+
+def backward_products(steps, left):
+    """accumulate the products from the end as y[k] = left@steps[-1]@...@steps[k+1]
+    Args:
+        steps (np.array) : stacked step propagators with the shape (T, dim, dim)
+        left (np.array) : matrix multiplied from the left with the shape (dim, dim)
+    Returns:
+        y (np.array) : stacked products with the shape (T, dim, dim)
+    """
+    y = np.empty(steps.shape, dtype=np.complex128)
+    current = np.asarray(left, dtype=np.complex128)
+    for k in range(steps.shape[0]-1, -1, -1):
+        y[k] = current
+        current = current@steps[k]
+    return y
+
+def adjoint_gradients(steps, prefix, val, vec, s_list, operator_tensor, left):
+    """compute the gradients of Re tr(left@U) with U = steps[-1]@...@steps[0] with respect to the coefficients of each step
+    Args:
+        steps (np.array) : stacked step propagators with the shape (T, dim, dim)
+        prefix (np.array) : cumulative propagators with the shape (T+1, dim, dim) starting from the identity
+        val (np.array) : eigenvalues of the step hamiltonians with the shape (T, dim)
+        vec (np.array) : eigenvectors of the step hamiltonians with the shape (T, dim, dim)
+        s_list (np.array) : width of each step
+        operator_tensor (np.array) : operators multiplied by the coefficients with the shape (n_ops, dim, dim)
+        left (np.array) : matrix defining the cost with the shape (dim, dim)
+    Returns:
+        gradients (np.array) : gradients with the shape (T, n_ops)
+    """
+    # tr(left@B_k@dU_k@A_k) = tr(lam_k@dU_k) with lam_k = A_k@left@B_k
+    lam = prefix[:-1]@backward_products(steps, left)
+    lam = vec.conj().swapaxes(-1,-2)@lam@vec
+    weight = lam.swapaxes(-1,-2)*expm_derivative_kernel(val, s_list)
+    weight = vec.conj()@weight@vec.swapaxes(-1,-2)
+    gradients = np.tensordot(weight, operator_tensor, axes=([1,2],[1,2])).real
+    return gradients
+
+def unitary_gradients(steps, prefix, val, vec, s_list, operator_tensor, left):
+    """compute the derivatives of left@U with U = steps[-1]@...@steps[0] with respect to the coefficients of each step
+    Args:
+        steps (np.array) : stacked step propagators with the shape (T, dim, dim)
+        prefix (np.array) : cumulative propagators with the shape (T+1, dim, dim) starting from the identity
+        val (np.array) : eigenvalues of the step hamiltonians with the shape (T, dim)
+        vec (np.array) : eigenvectors of the step hamiltonians with the shape (T, dim, dim)
+        s_list (np.array) : width of each step
+        operator_tensor (np.array) : operators multiplied by the coefficients with the shape (n_ops, dim, dim)
+        left (np.array) : matrix multiplied from the left with the shape (dim, dim)
+    Returns:
+        gradients (np.array) : derivatives with the shape (T, n_ops, dim, dim)
+    """
+    outer = backward_products(steps, left)@vec
+    inner = vec.conj().swapaxes(-1,-2)@prefix[:-1]
+    rotated = np.einsum("tab,jbc,tcd->tjad", vec.conj().swapaxes(-1,-2), operator_tensor, vec, optimize=True)
+    rotated *= expm_derivative_kernel(val, s_list)[:,None]
+    gradients = outer[:,None]@rotated@inner[:,None]
+    return gradients
@@ -1,16 +1,21 @@
-import itertools
 import numpy as np
 
 def get_computational_basis(sys):
-    label = list(itertools.product(*[range(d) for d in sys.dims]))
-    
     computational_basis = []
-    for idx, l in enumerate(label):
+    for idx, l in enumerate(sys.label):
         if 2 not in l:
             computational_basis.append(idx)
     return computational_basis
             
 def get_leakage(u, sys):
-    leakage = 1 - abs(np.linalg.det(u[sys.comp][:,sys.comp]))
+    """compute the leakage out of the computational subspace
+    Args:
+        u (np.array) : unitary with the shape (dim, dim), or stacked unitaries with the shape (T, dim, dim) such as a memmap trajectory
+        sys (System) : class for the target quantum system
+    Returns:
+        leakage (float or np.array) : leakage of each unitary
+    """
+    comp = np.asarray(sys.comp)
+    leakage = 1 - abs(np.linalg.det(u[...,comp[:,None],comp[None,:]]))
     return leakage
     
\ No newline at end of file
@@ -1,15 +1,19 @@
-from .tensor_product import TensorProduct
+from .tensor_product import TensorProduct, LocalOperator
 
-def state(system, str_dict):
+def state(system, str_dict, matrix_free=False):
     """generate state with the shape of the multi-qubit system
     Args:
         system (System) : multi-qubit system
         str_dict (dict) : {0:"S0", 1:"S1", 4:"Sp" ...} (missing index is transpiled as "S0")
+        matrix_free (bool) : whether to return a LocalOperator instead of the full matrix
     Returns:
-        output (np.array) : density matrix of the target state
+        output (np.array or LocalOperator) : density matrix of the target state
     """
     dims = [q.dim for q in system.qubits.values()]
-    tp = TensorProduct(*dims)
+    if matrix_free:
+        tp = LocalOperator(*dims)
+    else:
+        tp = TensorProduct(*dims)
     for idx, qubit in system.qubits.items():
         if idx in str_dict.keys():
             tp.prod(getattr(qubit, str_dict[idx]), idx)
@@ -18,19 +22,25 @@ def state(system, str_dict):
                 tp.prod(getattr(qubit, str_dict["default"]), idx)
             else:
                 tp.prod(getattr(qubit, "S0"), idx)
+    if matrix_free:
+        return tp
     output = tp.get_operator()
     return output
 
-def operator(system, str_dict):
+def operator(system, str_dict, matrix_free=False):
     """generate operator with the shape of the multi-qubit system
     Args:
         system (System) : multi-qubit system
         str_dict (dict) : {0:"X", 1:"sZ", 4:"A" ...} (missing index is transpiled as "I")
+        matrix_free (bool) : whether to return a LocalOperator instead of the full matrix
     Returns:
-        output (np.array) : unitary matrix of the target operator
+        output (np.array or LocalOperator) : unitary matrix of the target operator
     """
     dims = [q.dim for q in system.qubits.values()]
-    tp = TensorProduct(*dims)
+    if matrix_free:
+        tp = LocalOperator(*dims)
+    else:
+        tp = TensorProduct(*dims)
     for idx, qubit in system.qubits.items():
         if idx in str_dict.keys():
             tp.prod(getattr(qubit, str_dict[idx]), idx)
@@ -39,5 +49,7 @@ def operator(system, str_dict):
                 tp.prod(getattr(qubit, str_dict["default"]), idx)
             else:
                 pass
+    if matrix_free:
+        return tp
     output = tp.get_operator()
     return output
\ No newline at end of file
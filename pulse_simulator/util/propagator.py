@@ -0,0 +1,122 @@
+import numpy as np
+import scipy.sparse as sp
+
+def expm_hermitian(h, s, return_eigen=False):
+    """compute the propagators exp(-1j*h*s) of the stacked hermitian matrices at once
+    Args:
+        h (np.array) : stacked hermitian matrices with the shape (..., T, dim, dim)
+        s (np.array) : time step widths with the shape (T,)
+        return_eigen (bool) : whether to return also the eigendecomposition of h
+    Returns:
+        u (np.array) : stacked propagators with the shape (..., T, dim, dim)
+        val (np.array) : eigenvalues of h with the shape (..., T, dim) (only if return_eigen)
+        vec (np.array) : eigenvectors of h with the shape (..., T, dim, dim) (only if return_eigen)
+    """
+    val, vec = np.linalg.eigh(h)
+    phase = np.exp(-1j*val*np.asarray(s)[:,None])
+    u = (vec*phase[...,None,:])@vec.conj().swapaxes(-1,-2)
+    if return_eigen:
+        return u, val, vec
+    return u
+
+def frame_rotation(frame, t):
+    """compute the frame rotations exp(+1j*frame*t) for the list of times at once
+    Args:
+        frame (np.array) : hermitian generator of the rotating frame
+        t (np.array) : list of the elapsed times with the shape (T,)
+    Returns:
+        f (np.array) : stacked frame rotations with the shape (T, dim, dim)
+    """
+    if sp.issparse(frame):
+        frame = frame.toarray()
+    val, vec = np.linalg.eigh(frame)
+    phase = np.exp(+1j*np.outer(t, val))
+    f = (vec*phase[:,None,:])@vec.T.conj()
+    return f
+
+def cumulative_product(steps):
+    """accumulate the step propagators as u[k] = steps[k-1]@...@steps[0]
+    Args:
+        steps (np.array) : stacked step propagators with the shape (T, dim, dim)
+    Returns:
+        u (np.array) : stacked cumulative propagators with the shape (T+1, dim, dim) starting from the identity
+    """
+    u = np.empty((steps.shape[0]+1,) + steps.shape[1:], dtype=np.complex128)
+    u[0] = np.identity(steps.shape[1])
+    for i, step in enumerate(steps):
+        np.matmul(step, u[i], out=u[i+1])
+    return u
+
+def tree_product(steps):
+    """multiply the stacked propagators as steps[-1]@...@steps[0] by pairwise reduction
+    Args:
+        steps (np.array) : stacked step propagators with the shape (T, dim, dim)
+    Returns:
+        u (np.array) : total propagator
+    """
+    if steps.shape[0] == 0:
+        return np.identity(steps.shape[1], dtype=np.complex128)
+    while steps.shape[0] > 1:
+        n = steps.shape[0]//2
+        paired = steps[1:2*n:2]@steps[0:2*n:2]
+        if steps.shape[0] % 2:
+            paired = np.concatenate([paired, steps[-1:]])
+        steps = paired
+    return steps[0]
+
+def parallel_cumulative_product(steps, pool, chunks, return_all=True):
+    """accumulate the step propagators in chunks on the pool and fix up the prefixes of each chunk
+    Args:
+        steps (np.array) : stacked step propagators with the shape (T, dim, dim)
+        pool (Executor) : pool of workers to process the chunks
+        chunks (int) : number of chunks
+        return_all (bool) : whether to return every prefix or only the total propagator
+    Returns:
+        u (np.array) : stacked cumulative propagators with the shape (T+1, dim, dim) if return_all, otherwise the total propagator
+    """
+    identity = np.identity(steps.shape[1], dtype=np.complex128)
+    ranges = [r for r in np.array_split(np.arange(steps.shape[0]), chunks) if r.size > 0]
+
+    if return_all:
+        local = list(pool.map(lambda r: cumulative_product(steps[r[0]:r[-1]+1])[1:], ranges))
+        totals = [l[-1] for l in local]
+    else:
+        totals = list(pool.map(lambda r: tree_product(steps[r[0]:r[-1]+1]), ranges))
+
+    carry = [identity]
+    for total in totals:
+        carry.append(total@carry[-1])
+    if not return_all:
+        return carry[-1]
+
+    fixed = list(pool.map(lambda l, c: l@c, local, carry[:-1]))
+    u = np.concatenate([identity[None]] + fixed)
+    return u
+
+GAUSS_NODES = np.array([0.5 - np.sqrt(3)/6, 0.5 + np.sqrt(3)/6])
+CF4_WEIGHTS = np.array([0.25 + np.sqrt(3)/6, 0.25 - np.sqrt(3)/6])
+
+def magnus4_hamiltonian(h1, h2, s):
+    """compute the average hamiltonian of the fourth-order magnus expansion from the two gauss nodes
+    Args:
+        h1 (np.array) : stacked hamiltonians at the first gauss node with the shape (T, dim, dim)
+        h2 (np.array) : stacked hamiltonians at the second gauss node with the shape (T, dim, dim)
+        s (np.array) : time step widths with the shape (T,)
+    Returns:
+        h (np.array) : stacked hermitian matrices whose propagators exp(-1j*h*s) are the magnus steps
+    """
+    h = 0.5*(h1 + h2) + 1j*np.sqrt(3)/12*np.asarray(s)[:,None,None]*(h1@h2 - h2@h1)
+    return h
+
+def cf4_hamiltonians(h1, h2):
+    """compute the two exponents of the fourth-order commutator-free integrator from the two gauss nodes
+    Args:
+        h1 (np.array) : stacked hamiltonians at the first gauss node with the shape (T, dim, dim)
+        h2 (np.array) : stacked hamiltonians at the second gauss node with the shape (T, dim, dim)
+    Returns:
+        first (np.array) : hamiltonians of the exponential applied first
+        second (np.array) : hamiltonians of the exponential applied second
+    """
+    first = CF4_WEIGHTS[0]*h1 + CF4_WEIGHTS[1]*h2
+    second = CF4_WEIGHTS[1]*h1 + CF4_WEIGHTS[0]*h2
+    return first, second
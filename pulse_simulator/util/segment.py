@@ -0,0 +1,59 @@
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+def precompile(time, waveforms, return_all=True):
+    """split the sampled waveforms into the time steps to be exponentiated
+    Args:
+        time (np.array) : sampling times with the shape (T,)
+        waveforms (np.array) : waveform matrix with the shape (n_ops, T)
+        return_all (bool) : whether to keep every sampling point, otherwise each constant run is merged into one step
+    Returns:
+        i_list (np.array) : sample index at the end of each step (starting from 0)
+        s_list (np.array) : width of each step
+        c_list (np.array) : waveform coefficients of each step with the shape (n_steps, n_ops)
+    """
+    if time.size < 2:
+        return np.zeros(1, dtype=int), np.zeros(0), np.zeros([0, waveforms.shape[0]])
+
+    if return_all:
+        breaks = np.arange(1, time.size)
+    else:
+        changed = np.any(waveforms[:,1:] != waveforms[:,:-1], axis=0)
+        breaks = np.flatnonzero(changed) + 1
+        if breaks.size == 0 or breaks[-1] != time.size - 1:
+            breaks = np.append(breaks, time.size - 1)
+
+    # each break closes the preceding constant run (if any) and adds one midpoint step
+    prev = np.concatenate([[0], breaks[:-1]])
+    mask = np.stack([breaks - prev >= 2, np.ones(breaks.size, dtype=bool)], axis=1).ravel()
+    starts = np.stack([prev, breaks - 1], axis=1).ravel()[mask]
+    ends = np.stack([breaks - 1, breaks], axis=1).ravel()[mask]
+
+    i_list = np.concatenate([[0], ends])
+    s_list = time[ends] - time[starts]
+    c_list = 0.5*(waveforms[:,starts] + waveforms[:,ends]).T
+    return i_list, s_list, c_list
+
+def node_coefficients(time, waveforms, i_list, c_list, nodes):
+    """interpolate the waveform coefficients at the quadrature nodes of each step
+    Args:
+        time (np.array) : sampling times with the shape (T,)
+        waveforms (np.array) : waveform matrix with the shape (n_ops, T)
+        i_list (np.array) : sample index at the end of each step (starting from 0)
+        c_list (np.array) : waveform coefficients of each step with the shape (n_steps, n_ops)
+        nodes (np.array) : relative positions of the nodes in each step (0 to 1)
+    Returns:
+        c_nodes (np.array) : waveform coefficients with the shape (n_steps, n_nodes, n_ops)
+    """
+    starts, ends = i_list[:-1], i_list[1:]
+    c_nodes = np.repeat(c_list[:,None,:], len(nodes), axis=1)
+    if time.size < 4:
+        return c_nodes
+
+    # constant intervals keep their exact value whether merged or not, so that return_all does not change the result
+    # and idle stretches stay exactly zero, the other single sampling intervals use the cubic spline
+    single = (ends - starts == 1) & np.any(waveforms[:,starts] != waveforms[:,ends], axis=0)
+    spline = CubicSpline(time, waveforms, axis=1)
+    tau = time[starts[single],None] + np.asarray(nodes)[None,:]*(time[ends[single]] - time[starts[single]])[:,None]
+    c_nodes[single] = spline(tau).transpose(1, 2, 0)
+    return c_nodes
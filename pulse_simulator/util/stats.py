@@ -0,0 +1,103 @@
+import time
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+
+_DISABLED = nullcontext()
+
+class Stats:
+    """Class for collecting the timers and counters of the hot paths of the simulator"""
+
+    def __init__(self, enabled=False, hook=None):
+        """define whether the statistics are collected
+        Args:
+            enabled (bool) : whether to collect the statistics (disabled timers and counters return immediately)
+            hook (function) : function called as hook(event, name, value) with the event "start", "stop" (value is the elapsed time in s)
+                or "count" (value is the increment), such as for forwarding the ranges to an external profiler or logger
+        """
+        self.enabled = enabled
+        self.hook = hook
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.calls = {}
+        self.counters = {}
+
+    def __repr__(self):
+        print_str = "-"*50 + "\n"
+        print_str += f"Simulator Stats \n"
+        for name, total in self.timers.items():
+            print_str += "*" + f" {name:<22}= {total:.6f} s ({self.calls[name]} calls) \n"
+        for name, value in self.counters.items():
+            print_str += "*" + f" {name:<22}= {value} \n"
+        print_str += "-"*50
+        return print_str
+
+    def __str__(self):
+        return self.__repr__()
+
+    def reset(self):
+        """drop all the collected statistics"""
+        with self.lock:
+            self.timers = {}
+            self.calls = {}
+            self.counters = {}
+
+    def report(self):
+        """return the collected statistics
+        Returns:
+            report (dict) : {"timers" : {name : total time (s)}, "calls" : {name : number of calls}, "counters" : {name : value}}
+        """
+        with self.lock:
+            return {"timers":dict(self.timers), "calls":dict(self.calls), "counters":dict(self.counters)}
+
+    def timer(self, name):
+        """return the context manager accumulating the elapsed time of the block
+        Args:
+            name (str) : name of the timer
+        Returns:
+            context (contextmanager) : timing context, or a shared no-op context if disabled
+        """
+        if not self.enabled:
+            return _DISABLED
+        return self._timer(name)
+
+    @contextmanager
+    def _timer(self, name):
+        if self.hook is not None:
+            self.hook("start", name, None)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timers[name] = self.timers.get(name, 0.0) + elapsed
+                self.calls[name] = self.calls.get(name, 0) + 1
+            if self.hook is not None:
+                self.hook("stop", name, elapsed)
+
+    def count(self, name, value=1):
+        """increment the counter
+        Args:
+            name (str) : name of the counter
+            value (int) : increment
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.hook is not None:
+            self.hook("count", name, value)
+
+def timed(name):
+    """decorate the method of the class holding self.stats to accumulate its elapsed time
+    Args:
+        name (str) : name of the timer
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.timer(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
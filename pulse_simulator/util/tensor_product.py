@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse as sp
 
 class TensorProduct:
     """Class for computing the product of matrices with the tensor structure"""
@@ -43,4 +44,161 @@ class TensorProduct:
             output (np.array) : matrix
         """
         output = self.operator.reshape([self.total_dim, self.total_dim])
-        return output
\ No newline at end of file
+        return output
+
+class SparseTensorProduct:
+    """Class for computing the product of matrices with the tensor structure as a sparse matrix"""
+
+    def __init__(self, *dims):
+        """define the dimensions of the tensor structure
+        Args:
+            dims (int) : dimensions of the tensor structure
+        """
+        self.dims = np.array(dims)
+        self.size = len(dims)
+        self.total_dim = np.prod(self.dims)
+        self.operator = sp.identity(self.total_dim, dtype=np.complex128, format='csr')
+
+    def embed(self, operator, target):
+        """embed the local matrix into the full space with sparse kronecker products
+        Args:
+            operator (np.array) : matrix acting on the target (must be square matrix)
+            target (int or tuple) : index on the tensor product structure on which the matrix acts
+        Returns:
+            output (sp.csr_matrix) : matrix on the full space
+        """
+        if type(target) is int:
+            target = [target]
+        target = list(target)
+        operator = np.asarray(operator, dtype=np.complex128)
+
+        if len(target) == 1:
+            t = target[0]
+            left = sp.identity(int(np.prod(self.dims[:t])), format='csr')
+            right = sp.identity(int(np.prod(self.dims[t+1:])), format='csr')
+            return sp.kron(sp.kron(left, sp.csr_matrix(operator)), right, format='csr')
+
+        # operator-Schmidt decomposition O = sum_k A_k (x) B_k splitting off the first target
+        d0 = self.dims[target[0]]
+        dr = int(np.prod(self.dims[target[1:]]))
+        tensor = operator.reshape(d0, dr, d0, dr).transpose(0, 2, 1, 3).reshape(d0*d0, dr*dr)
+        u, s, vh = np.linalg.svd(tensor, full_matrices=False)
+        output = sp.csr_matrix((self.total_dim, self.total_dim), dtype=np.complex128)
+        for k in range(s.size):
+            if s[k] < 1e-14*s[0]:
+                break
+            a = s[k]*u[:,k].reshape(d0, d0)
+            b = vh[k].reshape(dr, dr)
+            output = output + self.embed(a, target[0])@self.embed(b, target[1:])
+        return output
+
+    def prod(self, operator, target):
+        """prod the matrix with the tensor structure
+        Args:
+            operator (np.array) : matrix to multipy (must be square matrix)
+            target (int or tuple) : index on the tensor product structure on which you want to multiply the matrix
+        """
+        self.operator = self.embed(operator, target)@self.operator
+
+    def get_operator(self):
+        """return matrix as a sparse matrix
+        Returns:
+            output (sp.csr_matrix) : matrix
+        """
+        output = self.operator.tocsr()
+        output.eliminate_zeros()
+        return output
+
+class LocalOperator:
+    """Class for applying the product of local matrices by tensor contraction without building the full matrix"""
+
+    paths = {}
+
+    def __init__(self, *dims):
+        """define the dimensions of the tensor structure
+        Args:
+            dims (int) : dimensions of the tensor structure
+        """
+        self.dims = np.array(dims)
+        self.size = len(dims)
+        self.total_dim = np.prod(self.dims)
+        self.factors = []
+
+    def prod(self, operator, target):
+        """prod the matrix with the tensor structure (applied after the registered ones)
+        Args:
+            operator (np.array) : matrix to multipy (must be square matrix)
+            target (int or tuple) : index on the tensor product structure on which you want to multiply the matrix
+        """
+        if type(target) is int:
+            target = [target]
+        target = tuple(target)
+        dims = self.dims[list(target)]
+        operator = np.asarray(operator, dtype=np.complex128).reshape(list(dims)*2)
+        self.factors.append((operator, target))
+
+    def apply(self, x):
+        """apply the operator to the state vectors or matrices by contracting only the target axes
+        Args:
+            x (np.array) : array with the shape (total_dim,) or (total_dim, k) such as a state or a unitary
+        Returns:
+            output (np.array) : operator@x with the same shape as x
+        """
+        shape = np.shape(x)
+        x = np.asarray(x, dtype=np.complex128).reshape(list(self.dims) + [-1])
+        n = self.size
+        for operator, target in self.factors:
+            o_idx = list(range(n+1, n+1+len(target))) + list(target)
+            x_idx = list(range(n+1))
+            t_idx = list(range(n+1))
+            for i, t in enumerate(target):
+                t_idx[t] = n+1+i
+            key = (x.shape, target)
+            if key not in self.paths:
+                self.paths[key] = np.einsum_path(operator, o_idx, x, x_idx, t_idx, optimize="optimal")[0]
+            x = np.einsum(operator, o_idx, x, x_idx, t_idx, optimize=self.paths[key])
+        output = x.reshape(shape)
+        return output
+
+    def __matmul__(self, other):
+        if isinstance(other, LocalOperator):
+            if list(other.dims) != list(self.dims):
+                raise ValueError(f'Tensor structures {list(self.dims)} and {list(other.dims)} do not match.')
+            output = LocalOperator(*self.dims)
+            output.factors = other.factors + self.factors
+            return output
+        return self.apply(other)
+
+    def get_operator(self):
+        """return matrix as a numpy array
+        Returns:
+            output (np.array) : matrix
+        """
+        output = self.apply(np.identity(self.total_dim, dtype=np.complex128))
+        return output
+
+def subspace_operator(dims, label, operator, target):
+    """compute the matrix elements of the local operator between the given basis states without building the full space
+    Args:
+        dims (list) : dimensions of the tensor structure
+        label (np.array) : labels of the basis states spanning the subspace with the shape (n, len(dims))
+        operator (np.array) : matrix acting on the target (must be square matrix)
+        target (int or tuple) : index on the tensor product structure on which the matrix acts
+    Returns:
+        output (np.array) : matrix on the subspace with the shape (n, n)
+    """
+    if type(target) is int:
+        target = [target]
+    target = list(target)
+    dims = np.array(dims)
+    label = np.asarray(label).reshape(-1, dims.size)
+    rest = [i for i in range(dims.size) if i not in target]
+
+    local = np.ravel_multi_index(label[:,target].T, dims[target])
+    operator = np.asarray(operator, dtype=np.complex128).reshape(np.prod(dims[target]), -1)
+    output = operator[np.ix_(local, local)]
+    if rest:
+        # the operator acts as the identity on the other indices
+        other = np.ravel_multi_index(label[:,rest].T, dims[rest])
+        output = output*(other[:,None] == other[None,:])
+    return output
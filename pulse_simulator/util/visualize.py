@@ -5,30 +5,56 @@ import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA
 from .operator import operator, state
 
-def tomography_data(system, unitary, conditions):
+def tomography_data(system, unitary, conditions, chunk=4096):
     """extract the tomography data
     Args:
         system (System) : class for the target quantum system
-        unitary (list) : list of the np.array of the target unitary matrices
+        unitary (list or np.array) : list of the target unitary matrices, or stacked ones with the shape (T, dim, dim) such as a memmap trajectory
         conditions (list) : measurement conditions to be extracted such as [(state0, observable0), ...]
+        chunk (int) : number of unitaries contracted at once
     """
-    data = {}
+    # every distinct state and observable is built once and grouped by the initial state
+    states = {}
+    observables = {}
+    groups = {}
     for condition in conditions:
-        ini = state(system, condition[0])
-        obs = operator(system, condition[1]) 
+        ini_key, obs_key = str(condition[0]), str(condition[1])
+        if ini_key not in states:
+            states[ini_key] = state(system, condition[0])
+            groups[ini_key] = []
+        if obs_key not in observables:
+            observables[obs_key] = operator(system, condition[1])
+        if obs_key not in groups[ini_key]:
+            groups[ini_key].append(obs_key)
+
+    if isinstance(unitary, list):
+        unitary = np.array(unitary)
+
+    results = {}
+    for ini_key, obs_keys in groups.items():
+        # tr(obs u ini u^dag) = sum_r val_r <u vec_r|obs|u vec_r>, so only rank(ini) columns are propagated
+        val, vec = np.linalg.eigh(states[ini_key])
+        keep = abs(val) > 1e-12*abs(val).max()
+        val, vec = val[keep], vec[:,keep]
+        obs = np.array([observables[key] for key in obs_keys])
         tmp = []
-        for u in unitary:
-            end = u@ini@u.T.conj()
-            tmp.append(np.trace(obs@end))
-        tmp = np.array(tmp).real
-        data[str(condition)] = tmp
+        for start in range(0, len(unitary), chunk):
+            psi = unitary[start:start+chunk]@vec
+            tmp.append(np.einsum("tar,oab,tbr,r->ot", psi.conj(), obs, psi, val, optimize=True).real)
+        tmp = np.concatenate(tmp, axis=1)
+        for key, value in zip(obs_keys, tmp):
+            results[(ini_key, key)] = value
+
+    data = {}
+    for condition in conditions:
+        data[str(condition)] = results[(str(condition[0]), str(condition[1]))]
     return data
             
 def hamiltonian_tomography_zx_data(system, unitary, control):
     """extract the hamiltonian tomography (zx) data
     Args:
         system (System) : class for the target quantum system
-        unitary (list) : list of the np.array of the target unitary matrices
+        unitary (list or np.array) : list of the target unitary matrices, or stacked ones with the shape (T, dim, dim) such as a memmap trajectory
         control (int) : index of the control qubit be prepared 0 or 1 state
     """
     inis = [{control:"S0"}, {control:"S1"}]
@@ -53,7 +79,7 @@ def hamiltonian_tomography_xz_data(system, unitary, control):
     """extract the hamiltonian tomography (xz) data
     Args:
         system (System) : class for the target quantum system
-        unitary (list) : list of the np.array of the target unitary matrices
+        unitary (list or np.array) : list of the target unitary matrices, or stacked ones with the shape (T, dim, dim) such as a memmap trajectory
         control (int) : index of the control qubit be prepared + or - state
     """
     inis = [{control:"Sp", "default":"Sp"}, {control:"Sm", "default":"Sp"}]
@@ -78,7 +104,7 @@ def hamiltonian_tomography_zz_data(system, unitary, control):
     """extract the hamiltonian tomography (zz) data
     Args:
         system (System) : class for the target quantum system
-        unitary (list) : list of the np.array of the target unitary matrices
+        unitary (list or np.array) : list of the target unitary matrices, or stacked ones with the shape (T, dim, dim) such as a memmap trajectory
         control (int) : index of the control qubit be prepared + or - state
     """
     inis = [{control:"S0", "default":"Sp"}, {control:"S1", "default":"Sp"}]